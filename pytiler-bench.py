@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+
+# Benchmarks for PyTiler
+#
+# Runs headlessly on a synthetic source texture, and times every phase of
+# auto mode: decode, tile extraction (with border), layout, compose and
+# encode. Results are written as JSON, and can be compared with the results
+# of another version: only entry points of every version are used (render()
+# and save(), or run() for versions without render()), and phases timed by
+# pytiler stats are reported when the version has them.
+#
+# Examples:
+# ./pytiler-bench.py --quick -o before.json
+# ./pytiler-bench.py --quick -o after.json --compare=before.json
+# ./pytiler-bench.py --full --engine=numpy -o full.json
+
+from __future__ import print_function
+import contextlib
+import getopt
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import pygame
+
+import pytiler
+
+# Configuration every sweep starts from
+BASELINE = {
+    'size': 2048,
+    'tile_size': 64,
+    'nr_tiles': 64,
+    'brick': False,
+    'rotate': False,
+    'random_width': False,
+    'border': 0,
+    'remove_after_use': False,
+}
+
+# Values swept for each parameter
+SWEEP = {
+    'size': [512, 1024, 2048, 4096, 8192],
+    'tile_size': [16, 32, 64, 128, 256],
+    'nr_tiles': [8, 64, 256, 1024],
+    'brick': [False, True],
+    'rotate': [False, True],
+    'random_width': [False, True],
+    'border': [0, 4],
+    'remove_after_use': [False, True],
+}
+
+QUICK_SWEEP = {
+    'size': [512, 2048],
+    'tile_size': [32, 128],
+    'nr_tiles': [16, 256],
+    'brick': [False, True],
+    'rotate': [False, True],
+    'random_width': [False, True],
+    'border': [0, 4],
+    'remove_after_use': [False, True],
+}
+
+PHASES = ('decode', 'extract', 'plan', 'compose', 'render', 'encode')
+# Phases of pytiler stats reported as bench phases
+STATS_PHASES = {'extract': 'extract', 'layout': 'plan', 'compose': 'compose'}
+
+SOURCE_SIZE = 1024
+SEED = 1976
+
+
+def error(msg):
+    print(("Error: %s\n") % (msg))
+
+
+def make_source(filename, size, seed):
+    '''Write a synthetic texture: random overlapping colored rectangles
+    on a gradient, so that every crop is different'''
+    rng = random.Random(seed)
+    surface = pygame.Surface((size, size), 0, 32)
+    for y in range(size):
+        shade = y * 255 // size
+        pygame.draw.line(surface, (shade, 255 - shade, 128), (0, y), (size - 1, y))
+    for _ in range(2000):
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        rect = (rng.randrange(size), rng.randrange(size), rng.randrange(4, 96), rng.randrange(4, 96))
+        pygame.draw.rect(surface, color, rect)
+    pygame.image.save(surface, filename)
+
+
+def reset_peak_rss():
+    '''Reset peak resident set size of the process, when the OS allows it'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    '''Return peak resident set size in KiB, since last reset_peak_rss()
+    on Linux, or since process start otherwise'''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB elsewhere
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+class Bench:
+    def __init__(self):
+        self.quick = False
+        self.full = False
+        self.repeat = 3
+        self.engine = 'pygame'
+        self.outfilename = 'bench_output.json'
+        self.compare = ""
+        self.cache_dir = ""
+        self.results = []
+
+    def usage(self):
+        print("Usage: " + os.path.basename(sys.argv[0]) + " [options]")
+        print("\nOptions:\n")
+        print("  -o filename        JSON results file (default: bench_output.json)")
+        print("  --cache-dir=dir    Keep decoded source in dir, like pytiler --cache-dir")
+        print("  --compare=filename Compare results with a previous results file")
+        print("  --engine=name      Compositing engine: pygame (default) or numpy")
+        print("  --full             Run every combination of parameters, instead of")
+        print("                     sweeping one parameter at a time from the baseline")
+        print("  --quick            Sweep fewer values")
+        print("  --repeat=num       Keep the best of num runs of each phase (default: 3)")
+
+    def parse_args(self):
+        try:
+            opts, args = getopt.getopt(sys.argv[1:], "o:",
+                                       ["cache-dir=", "compare=", "engine=", "full", "quick", "repeat=",
+                                        "help"])
+        except getopt.GetoptError as err:
+            error(str(err))
+            self.usage()
+            exit(1)
+
+        for o, a in opts:
+            if o == "-o":
+                self.outfilename = a
+            elif o == "--cache-dir":
+                self.cache_dir = a
+            elif o == "--compare":
+                self.compare = a
+            elif o == "--engine":
+                if a not in ('pygame', 'numpy'):
+                    error(("Invalid engine '%s'") % (a))
+                    self.usage()
+                    exit(1)
+                self.engine = a
+            elif o == "--full":
+                self.full = True
+            elif o == "--quick":
+                self.quick = True
+            elif o == "--repeat":
+                self.repeat = max(1, int(a))
+            elif o == "--help":
+                self.usage()
+                exit(0)
+
+    def configs(self):
+        '''Yield configurations to benchmark'''
+        sweep = QUICK_SWEEP if self.quick else SWEEP
+        if self.full:
+            names = list(sweep)
+            for values in itertools.product(*[sweep[name] for name in names]):
+                yield dict(zip(names, values))
+            return
+        yield dict(BASELINE)
+        for name, values in sweep.items():
+            for value in values:
+                if value != BASELINE[name]:
+                    config = dict(BASELINE)
+                    config[name] = value
+                    yield config
+
+    def make_tiler(self, config, source, outfilename):
+        tiler = pytiler.PyTiler()
+        # Attributes rather than set_options(), which older versions lack.
+        # Options unknown to a version are ignored by it.
+        options = {
+            'auto': True,
+            'filename': source,
+            'outfilename': outfilename,
+            'seed': SEED,
+            'engine': self.engine,
+            'cache_dir': self.cache_dir,
+            'width': config['size'],
+            'height': config['size'],
+            'tile_width': config['tile_size'],
+            'tile_height': config['tile_size'],
+            'nr_tiles': config['nr_tiles'],
+            'brick': config['brick'],
+            'rotate': config['rotate'],
+            'random_width': config['random_width'],
+            'border': config['border'],
+            'remove_after_use': config['remove_after_use'],
+        }
+        for name, value in options.items():
+            setattr(tiler, name, value)
+        return tiler
+
+    @staticmethod
+    def render(tiler):
+        '''Render output of tiler into tiler.display'''
+        if hasattr(tiler, 'render'):
+            tiler.render()
+            return
+        # Versions without render() load tiles and draw them in run(),
+        # which returns once the posted QUIT event is handled
+        pygame.display.set_mode((tiler.width, tiler.height))
+        pygame.event.post(pygame.event.Event(pygame.QUIT))
+        tiler.run()
+
+    def run_config(self, config, source, outfilename):
+        '''Time every phase of one configuration, return one result per phase
+        the version reports'''
+        timings = dict((phase, []) for phase in PHASES)
+        peaks = dict((phase, 0) for phase in PHASES)
+
+        def timed(phase, function, *args):
+            reset_peak_rss()
+            start = time.perf_counter()
+            value = function(*args)
+            timings[phase].append(time.perf_counter() - start)
+            peaks[phase] = max(peaks[phase], peak_rss())
+            return value
+
+        stats = getattr(pytiler, 'stats', None)
+        nr_placed = None
+        for _ in range(self.repeat):
+            # Silence PyTiler progress messages, they are not benchmarked
+            with contextlib.redirect_stdout(io.StringIO()):
+                tiler = self.make_tiler(config, source, outfilename)
+                if hasattr(tiler, 'load_source'):
+                    timed('decode', tiler.load_source)
+                else:
+                    timed('decode', pygame.image.load, source)
+
+                tiler = self.make_tiler(config, source, outfilename)
+                if stats is not None:
+                    stats.reset()
+                timed('render', self.render, tiler)
+                timed('encode', tiler.save)
+            if stats is not None:
+                phases = stats.report()['phases']
+                for name, phase in STATS_PHASES.items():
+                    if name in phases:
+                        timings[phase].append(phases[name]['seconds'])
+                        peaks[phase] = peaks['render']
+                nr_placed = stats.report()['counters'].get('tiles_placed')
+            elif getattr(tiler, 'layout', None) is not None:
+                nr_placed = len(tiler.layout)
+            del tiler
+
+        results = []
+        for phase in PHASES:
+            if not timings[phase]:
+                continue
+            wall = min(timings[phase])
+            count = config['nr_tiles'] if phase in ('decode', 'extract') else nr_placed
+            results.append({
+                'config': config,
+                'phase': phase,
+                'wall': wall,
+                'tiles': count,
+                # Unknown when the version does not report placed tiles
+                'per_tile': None if count is None else wall / max(count, 1),
+                'peak_rss_kb': peaks[phase],
+            })
+        return results
+
+    def run(self):
+        pygame.init()
+        with tempfile.TemporaryDirectory(prefix='pytiler-bench-') as tmpdir:
+            source = os.path.join(tmpdir, 'source.png')
+            outfilename = os.path.join(tmpdir, 'out.png')
+            make_source(source, SOURCE_SIZE, SEED)
+            for config in self.configs():
+                try:
+                    results = self.run_config(config, source, outfilename)
+                except Exception as e:
+                    # Older versions may not support every configuration
+                    error("%s: %s" % (self.describe(config), e))
+                    continue
+                self.results.extend(results)
+                self.print_results(config, results)
+        pygame.quit()
+
+        report = {
+            'meta': self.meta(),
+            'results': self.results,
+        }
+        with open(self.outfilename, 'w') as f:
+            json.dump(report, f, indent=1)
+        print("Saved results into " + self.outfilename)
+
+        if self.compare:
+            self.print_comparison(self.compare)
+
+    def meta(self):
+        '''Describe the run, so that results files can be told apart'''
+        return {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'pygame': pygame.version.ver,
+            'numpy': getattr(pytiler, 'numpy', None) and pytiler.numpy.__version__,
+            'platform': platform.platform(),
+            'engine': self.engine,
+            'repeat': self.repeat,
+            'source_size': SOURCE_SIZE,
+            'seed': SEED,
+        }
+
+    @staticmethod
+    def describe(config):
+        flags = [name for name in ('brick', 'rotate', 'random_width', 'remove_after_use') if config[name]]
+        if config['border']:
+            flags.append('border=%d' % config['border'])
+        return "%dpx tile=%d n=%d %s" % (config['size'], config['tile_size'],
+                                         config['nr_tiles'], ' '.join(flags))
+
+    def print_results(self, config, results):
+        print(self.describe(config))
+        for result in results:
+            per_tile = "%9.2f" % (result['per_tile'] * 1e6) if result['per_tile'] is not None else "%9s" % '-'
+            print("  %-8s %9.2f ms %s us/tile %9d KiB" %
+                  (result['phase'], result['wall'] * 1e3, per_tile, result['peak_rss_kb']))
+
+    def print_comparison(self, filename):
+        '''Print wall time ratio of every phase run in both results files'''
+        with open(filename) as f:
+            previous = json.load(f)
+        key = lambda result: (json.dumps(result['config'], sort_keys=True), result['phase'])
+        before = dict((key(result), result) for result in previous['results'])
+        print("\nComparison with %s (new time / old time):\n" % filename)
+        for result in self.results:
+            old = before.get(key(result))
+            if old is None or old['wall'] == 0:
+                continue
+            ratio = result['wall'] / old['wall']
+            print("  %-40s %-8s %9.2f ms -> %9.2f ms  x%.2f" %
+                  (self.describe(result['config']), result['phase'],
+                   old['wall'] * 1e3, result['wall'] * 1e3, ratio))
+
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    # Headless: nothing is displayed
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    bench = Bench()
+    bench.parse_args()
+    bench.run()
+    sys.exit()
@@ -6,8 +6,10 @@
 
 from __future__ import print_function
 
+import os
+import random
 import sys
-from PyQt5 import QtWidgets, QtGui, QtCore
+from PyQt5 import QtWidgets, QtGui, QtCore, sip
 import pygame
 
 import pytiler
@@ -17,6 +19,10 @@ TILE_HEIGHT_MAX = 1024
 OUT_WIDTH_MAX   = 4096
 OUT_HEIGHT_MAX  = 4096
 
+# Wait for options to stop changing this long (ms) before rendering preview
+PREVIEW_DELAY   = 150
+PREVIEW_SIZE    = 384
+
 class PyTilerSignals(QtCore.QObject):
     '''Signals'''
     inputNameChanged = QtCore.pyqtSignal(str)
@@ -25,6 +31,79 @@ class PyTilerSignals(QtCore.QObject):
     tileHeightChanged = QtCore.pyqtSignal(int)
     outWidthChanged = QtCore.pyqtSignal(int)
     outHeightChanged = QtCore.pyqtSignal(int)
+    renderDone = QtCore.pyqtSignal(int, object, object)
+    renderFailed = QtCore.pyqtSignal(int, str)
+
+def surfaceImage(surface):
+    '''Return a QImage sharing pixels memory with a 32 bit pygame surface,
+    and the surface buffer which must be kept alive as long as the image'''
+    masks = surface.get_masks()[:3]
+    if masks == (0xff0000, 0xff00, 0xff):
+        fmt = QtGui.QImage.Format_RGB32
+    elif masks == (0xff, 0xff00, 0xff0000) and sys.byteorder == 'little':
+        fmt = QtGui.QImage.Format_RGBX8888
+    else:
+        converted = pygame.Surface(surface.get_size(), 0, 32, (0xff0000, 0xff00, 0xff, 0))
+        converted.blit(surface, (0, 0))
+        surface = converted
+        fmt = QtGui.QImage.Format_RGB32
+    buf = surface.get_buffer()
+    image = QtGui.QImage(sip.voidptr(buf), surface.get_width(), surface.get_height(),
+                         surface.get_pitch(), fmt)
+    return buf, image
+
+class RenderTask(QtCore.QRunnable):
+    '''Render tiler options off the GUI thread, and save output if asked.
+    Previews are drawn with tiles shrunk to fit PREVIEW_SIZE, only saved
+    output is rendered in full. Rendering is abandoned between bands of
+    rows once isStale() is true.'''
+    def __init__(self, options, generation, isStale, signals, save=False):
+        super(RenderTask, self).__init__()
+        self.options = options
+        self.generation = generation
+        self.isStale = isStale
+        self.signals = signals
+        self.save = save
+
+    def run(self):
+        try:
+            surface = self.render()
+        except (Exception, SystemExit) as e:
+            self.signals.renderFailed.emit(self.generation, "Render failed: %s" % e)
+            return
+        if surface is not None:
+            buf, image = surfaceImage(surface)
+            self.signals.renderDone.emit(self.generation, buf, image)
+
+    def render(self):
+        tiler = pytiler.PyTiler()
+        tiler.set_options(self.options)
+        tiler.init_seed()
+        tiler.load_tiles()
+        if self.isStale():
+            return None
+        layout = tiler.plan()
+        if not self.save:
+            # Same tiles and layout as the output, only smaller
+            scale = PREVIEW_SIZE / max(layout.width, layout.height)
+            if scale < 1:
+                layout = layout.scaled(max(1, round(layout.tile_width * scale)),
+                                       max(1, round(layout.tile_height * scale)))
+        tiler.layout = layout
+        surface = pygame.Surface((layout.width, layout.height), 0, 32)
+        nr_rows = layout.nr_rows
+        band_rows = max(1, 256 // layout.tile_height)
+        for first_row in range(0, nr_rows, band_rows):
+            if self.isStale():
+                return None
+            last_row = min(first_row + band_rows, nr_rows)
+            y = first_row * layout.tile_height
+            rect = pygame.Rect(0, y, layout.width, min(last_row * layout.tile_height, layout.height) - y)
+            tiler.rasterize(layout, surface.subsurface(rect), first_row, last_row)
+        if self.save:
+            tiler.display = surface
+            tiler.save()
+        return surface
 
 class PyTilerWin(QtWidgets.QWidget):
 
@@ -33,12 +112,81 @@ class PyTilerWin(QtWidgets.QWidget):
         # model
         self.tiler = tiler
         tiler.auto = True
+        # Keep the same seed while options are tweaked, so that preview only
+        # changes with them, and saved output is the previewed one
+        if tiler.seed == 0:
+            tiler.seed = random.randrange(sys.maxsize)
         # ui
         super(PyTilerWin, self).__init__()
         self.sig = PyTilerSignals()
+        # Renders run one at a time in the background: pytiler uses the
+        # global random generator. Every new render makes older ones stale.
+        self.generation = 0
+        self.pool = QtCore.QThreadPool()
+        self.pool.setMaxThreadCount(1)
+        # Preview waiting in pool, replaced by next one. Saves are never
+        # dropped.
+        self.queuedPreview = None
+        self.previewTimer = QtCore.QTimer()
+        self.previewTimer.setSingleShot(True)
+        self.previewTimer.setInterval(PREVIEW_DELAY)
+        self.previewTimer.timeout.connect(self.startPreview)
+        self.sig.renderDone.connect(self.renderDone)
+        self.sig.renderFailed.connect(self.renderFailed)
         self.initUI()
         self.show()
 
+    def schedulePreview(self):
+        '''Render preview once options stop changing for PREVIEW_DELAY'''
+        self.previewTimer.start()
+
+    def canRender(self):
+        t = self.tiler
+        if min(t.tile_width, t.tile_height, t.width, t.height) <= 0:
+            return False
+        return not t.auto or os.path.isfile(t.filename)
+
+    def dropQueuedPreview(self):
+        '''Remove preview from pool, if it has not started yet'''
+        if self.queuedPreview is not None:
+            self.pool.tryTake(self.queuedPreview)
+            self.queuedPreview = None
+
+    def startRender(self, save=False):
+        '''Queue a render of current options, dropping queued preview'''
+        self.previewTimer.stop()
+        if not self.canRender():
+            self.preview.setText("Choose input file and sizes")
+            return
+        self.generation += 1
+        generation = self.generation
+        isStale = lambda: generation != self.generation
+        if save:
+            # Output is always saved in full
+            isStale = lambda: False
+        self.dropQueuedPreview()
+        task = RenderTask(self.tiler.get_options(), generation, isStale, self.sig, save)
+        if not save:
+            # Kept alive by Python, so that it can still be taken from pool
+            task.setAutoDelete(False)
+            self.queuedPreview = task
+        self.pool.start(task)
+
+    def startPreview(self):
+        self.startRender()
+
+    def renderDone(self, generation, buf, image):
+        if generation != self.generation:
+            return
+        pixmap = QtGui.QPixmap.fromImage(image)
+        self.preview.setPixmap(pixmap.scaled(self.preview.size(), QtCore.Qt.KeepAspectRatio,
+                                             QtCore.Qt.SmoothTransformation))
+
+    def renderFailed(self, generation, msg):
+        print(msg)
+        if generation == self.generation:
+            self.preview.setText(msg)
+
     def tileSizeChanged(self, size):
         if size.lower() != 'custom':
             self.sig.tileWidthChanged.emit(int(size.split('x')[0]))
@@ -47,14 +195,17 @@ class PyTilerWin(QtWidgets.QWidget):
     def tileWidthChanged(self, width):
         print(f"Tile Width: {width}")
         self.tiler.tile_width = width
+        self.schedulePreview()
 
     def tileHeightChanged(self, height):
         print(f"Tile Height: {height}")
         self.tiler.tile_height = height
+        self.schedulePreview()
 
     def borderWidthChanged(self, width):
         print(f"Border Width: {width}")
         self.tiler.border = width
+        self.schedulePreview()
 
     def outSizeChanged(self, size):
         if size.lower() != 'custom':
@@ -67,14 +218,17 @@ class PyTilerWin(QtWidgets.QWidget):
             print(f"Input filename: {filename}")
             self.sig.inputNameChanged.emit(filename)
             self.tiler.filename = filename
+            self.schedulePreview()
 
     def outputWidthChanged(self, width):
         print(f"Output Width: {width}")
         self.tiler.width = width
+        self.schedulePreview()
 
     def outputHeightChanged(self, height):
         print(f"Output Height: {height}")
         self.tiler.height = height
+        self.schedulePreview()
 
     def chooseOutputFilename(self):
         filename, _ = QtWidgets.QFileDialog.getSaveFileName(self, 'Choose output file...')
@@ -86,16 +240,21 @@ class PyTilerWin(QtWidgets.QWidget):
     def autogenerateClicked(self, checked):
         self.tiler.auto = checked
         print(f"Auto-generate: {self.tiler.auto}")
+        self.schedulePreview()
 
     def brickLayoutClicked(self, checked):
         self.tiler.brick = checked
         print(f"Brick layout: {self.tiler.brick}")
+        self.schedulePreview()
+
+    def randomizeClicked(self):
+        self.tiler.seed = random.randrange(sys.maxsize)
+        print(f"Seed: {self.tiler.seed}")
+        self.startRender()
 
     def renderButtonClicked(self):
         print("Render")
-        pygame.init()
-        self.tiler.run()
-        pygame.quit()
+        self.startRender(save=True)
 
     def initUI(self):
         self.setGeometry(300, 300, 250, 150)
@@ -224,12 +383,25 @@ class PyTilerWin(QtWidgets.QWidget):
         hbox.addStretch()
         innervbox.addLayout(hbox)
 
+        #
+        # Preview
+        #
+        self.preview = QtWidgets.QLabel("Choose input file and sizes")
+        self.preview.setAlignment(QtCore.Qt.AlignCenter)
+        self.preview.setFixedSize(PREVIEW_SIZE, PREVIEW_SIZE)
+        vbox.addWidget(self.preview)
+
         #
         # Render/Randomize
         #
+        hbox = QtWidgets.QHBoxLayout()
+        button = QtWidgets.QPushButton('Randomize')
+        button.clicked.connect(self.randomizeClicked)
+        hbox.addWidget(button)
         button = QtWidgets.QPushButton('Render')
         button.clicked.connect(self.renderButtonClicked)
-        vbox.addWidget(button)
+        hbox.addWidget(button)
+        vbox.addLayout(hbox)
 
         vbox.addStretch()
         self.setLayout(vbox)
@@ -237,9 +409,16 @@ class PyTilerWin(QtWidgets.QWidget):
 
 def main():
     app = QtWidgets.QApplication(sys.argv)
+    pygame.init()
     tiler = pytiler.PyTiler()
     w = PyTilerWin(tiler)
-    sys.exit(app.exec_())
+    status = app.exec_()
+    # Queued saves still run
+    w.dropQueuedPreview()
+    w.generation += 1
+    w.pool.waitForDone()
+    pygame.quit()
+    sys.exit(status)
 
 if __name__ == '__main__':
     main()
@@ -13,46 +13,1240 @@
 # TILESIZE=64 ~/src/pytiler/pytiler.py -p face-2017112 -H $TILESIZE -W $TILESIZE -h $((20 * TILESIZE)) -w $((20 * TILESIZE)) --remove-after-use -o poster.png
 
 from __future__ import print_function
+import array
+import base64
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import cProfile
 import getopt
+import hashlib
+import io
+import itertools
+import json
+import math
+import mmap
+import multiprocessing
 import os
 import random
+import shlex
+import shutil
+import socketserver
+import struct
 import sys
+import tempfile
+import threading
 import time
-import pygame
+import zlib
+# Standard output is kept for output of PyTiler, like answers of --serve
+with contextlib.redirect_stdout(sys.stderr):
+    import pygame
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 def error(msg):
     print(("Error: %s\n") % (msg))
 
 
+# Print messages of hot paths too (per tile, per row)
+verbose = False
+
+def debug(msg):
+    if verbose:
+        print(msg)
+
+
+#-------------------------------------------------------------------------------
+class Stats:
+    '''Time spent in each phase of a run, and event counters.
+    Phases may nest: border is part of extract.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # Phase name -> [seconds, calls], in order of first use
+        self.phases = collections.OrderedDict()
+        self.counters = collections.Counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                entry = self.phases.setdefault(name, [0.0, 0])
+                entry[0] += elapsed
+                entry[1] += 1
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def report(self):
+        '''Return stats as a dictionary'''
+        with self.lock:
+            phases = collections.OrderedDict(
+                (name, {'seconds': seconds, 'calls': calls})
+                for name, (seconds, calls) in self.phases.items())
+            return {'phases': phases, 'counters': dict(self.counters)}
+
+    def merge(self, report):
+        '''Add stats reported by another process'''
+        with self.lock:
+            for name, phase in report['phases'].items():
+                entry = self.phases.setdefault(name, [0.0, 0])
+                entry[0] += phase['seconds']
+                entry[1] += phase['calls']
+            self.counters.update(report['counters'])
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+
+
+# Stats of the current run
+stats = Stats()
+
+
 #-------------------------------------------------------------------------------
 class Tile:
-    '''Tile object. Stores a filename and the pygame surface.'''
+    '''Tile object. Stores a filename and the pygame surface.
+
+    Rotated and scaled versions of the surface are kept in a small LRU cache
+    keyed by (angle, width, height), so that drawing the same tile many times
+    does not resample it again and again.'''
 
-    def __init__(self, filename=None, surface=None):
-        if filename != None:
-            print("Load %s" % (filename))
-            self.filename = filename
-            self.surface = pygame.image.load(filename)
+    # Maximum number of transformed variants kept per tile
+    variants_max = 8
+    # Maximum memory (in bytes) used by the transformed variants of a tile
+    variants_max_bytes = 16 * 1024 * 1024
+
+    # Tiles may be counted in tens of thousands
+    __slots__ = ('filename', 'loader', 'weight', 'pending', '_surface', '_rect',
+                 'variants', 'variants_bytes')
+
+    def __init__(self, filename=None, surface=None, loader=None):
+        self.filename = filename
+        self.loader = loader
+        # Relative probability of being drawn by WeightedSampler
+        self.weight = 1.0
+        # Background decoding of the tile file, if any
+        self.pending = None
+        self._surface = None
+        if filename != None and loader is None:
+            debug("Load %s" % (filename))
+            with stats.phase('decode'):
+                self._surface = pygame.image.load(filename)
+            stats.count('tiles_decoded')
         elif surface != None:
-            self.surface = surface
-        self.rect = self.surface.get_rect()
+            self._surface = surface
+        if self._surface is not None:
+            self._rect = self._surface.get_rect()
+        # Made when a first variant is kept
+        self.variants = None
+        self.variants_bytes = 0
+
+    def load(self):
+        '''Decode tile file with its loader, if not done yet'''
+        if self._surface is None:
+            self._surface = self.loader.get(self)
+            self._rect = self._surface.get_rect()
+
+    @property
+    def surface(self):
+        '''Tile surface, decoded on first use when loaded by a TileLoader'''
+        self.load()
+        return self._surface
+
+    @property
+    def rect(self):
+        self.load()
+        return self._rect
 
     def __str__(self):
         s = self.filename
         return s
 
+    def variant(self, width, height, angle):
+        '''Return tile surface rotated by angle and scaled to width x height'''
+        key = (angle, width, height)
+        surface = self.variants.get(key) if self.variants is not None else None
+        if surface is not None:
+            self.variants.move_to_end(key)
+            stats.count('variant_hits')
+            return surface
+
+        surface = self.surface
+        if surface.get_size() == (width, height) and angle % 360 == 0:
+            # Nothing to transform, no need to cache anything
+            return surface
+        stats.count('transforms')
+        if angle % 360 != 0:
+            #surface = pygame.transform.rotozoom(self.surface, angle, 1.0)
+            surface = pygame.transform.rotate(surface, angle)
+        if surface.get_size() != (width, height):
+            surface = pygame.transform.smoothscale(surface, (width, height))
+
+        size = width * height * surface.get_bytesize()
+        if size > self.variants_max_bytes:
+            return surface
+        if self.variants is None:
+            self.variants = collections.OrderedDict()
+        self.variants[key] = surface
+        self.variants_bytes += size
+        # Evict least recently used variants
+        while len(self.variants) > self.variants_max or \
+              self.variants_bytes > self.variants_max_bytes:
+            _, old = self.variants.popitem(last=False)
+            self.variants_bytes -= old.get_width() * old.get_height() * old.get_bytesize()
+        return surface
+
+    def warm(self, width, height, angles):
+        '''Pre-compute the variants for the given size and angles'''
+        for angle in angles:
+            self.variant(width, height, angle)
+
     def draw_at(self, display, x, y, width, height, angle):
-        #surface = pygame.transform.rotozoom(self.surface, angle, 1.0)
-        surface = pygame.transform.rotate(self.surface, angle)
-        surface = pygame.transform.smoothscale(surface, (width, height))
-        display.blit(surface, self.rect.move(x, y))
+        display.blit(self.variant(width, height, angle), self.rect.move(x, y))
+
+
+#-------------------------------------------------------------------------------
+class TileAtlas:
+    '''Tiles packed into a single surface, left to right in rows of a
+    roughly square atlas. Position and size of every tile are kept in
+    arrays. It is a sequence of tiles like a list, but each Tile is only
+    made when first used, as a subsurface sharing atlas pixels.'''
+
+    def __init__(self, surface, x, y, width, height, opaque=None):
+        self.surface = surface
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        # Flags of tiles without alpha, in an atlas with alpha
+        self.opaque = opaque
+        self.tiles = [None] * len(width)
+
+    @classmethod
+    def pack(cls, widths, heights, surface):
+        '''Return an empty atlas for tiles of the given sizes, with the pixel
+        format of surface'''
+        row_height = max(heights, default=1)
+        x = y = 0
+        xs = array.array('i')
+        ys = array.array('i')
+        atlas_width = max(max(widths, default=1), math.isqrt(sum(widths) * row_height))
+        for width in widths:
+            if x + width > atlas_width:
+                x = 0
+                y += row_height
+            xs.append(x)
+            ys.append(y)
+            x += width
+        atlas = pygame.Surface((atlas_width, y + row_height), surface.get_flags() & pygame.SRCALPHA,
+                               surface.get_bitsize(), surface.get_masks())
+        return cls(atlas, xs, ys, array.array('i', widths), array.array('i', heights))
+
+    @classmethod
+    def of_tiles(cls, tiles):
+        '''Return tiles copied into an atlas, or tiles if they are one'''
+        if isinstance(tiles, TileAtlas):
+            return tiles
+        surfaces = [tile.surface for tile in tiles]
+        alpha = any(surface.get_flags() & pygame.SRCALPHA for surface in surfaces)
+        atlas = cls.pack([surface.get_width() for surface in surfaces],
+                         [surface.get_height() for surface in surfaces],
+                         pygame.Surface((1, 1), pygame.SRCALPHA if alpha else 0, 32 if alpha else 24))
+        if alpha:
+            atlas.opaque = array.array('i', [not surface.get_flags() & pygame.SRCALPHA
+                                             for surface in surfaces])
+        for index, surface in enumerate(surfaces):
+            # Atlas is transparent black: the greatest of atlas and tile
+            # values is a copy of the tile, alpha included
+            flags = pygame.BLEND_RGBA_MAX if surface.get_flags() & pygame.SRCALPHA else 0
+            atlas.surface.blit(surface, (atlas.x[index], atlas.y[index]), special_flags=flags)
+        return atlas
+
+    def __len__(self):
+        return len(self.width)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        tile = self.tiles[index]
+        if tile is None:
+            surface = self.surface.subsurface(self.rect(index))
+            if self.opaque is not None and self.opaque[index]:
+                # Scaled like the original tile only without alpha
+                opaque = pygame.Surface(surface.get_size(), 0, 24)
+                opaque.blit(surface, (0, 0))
+                surface = opaque
+            tile = Tile(surface=surface)
+            self.tiles[index] = tile
+        return tile
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def rect(self, index):
+        return pygame.Rect(self.x[index], self.y[index], self.width[index], self.height[index])
+
+    def rows(self):
+        '''Yield (y, tuple of tiles widths) of every row of the atlas'''
+        start = 0
+        for end in range(1, len(self) + 1):
+            if end == len(self) or self.y[end] != self.y[start]:
+                yield self.y[start], tuple(self.width[start:end])
+                start = end
+
+    def made(self):
+        '''Return tiles made so far'''
+        return [tile for tile in self.tiles if tile is not None]
+
+
+def tile_widths(tiles):
+    '''Return width of every tile, without making the tiles of an atlas'''
+    if isinstance(tiles, TileAtlas):
+        return tiles.width
+    return [tile.rect.width for tile in tiles]
+
+
+#-------------------------------------------------------------------------------
+class TileMap:
+    '''Texture kept as the atlas of its tiles and their layout instead of its
+    pixels, which any region of the texture can be rendered from.
+
+    File format: 'PYTM', length of a JSON header, then zlib compressed
+    sections whose lengths are in the header: x, y, width, height and
+    opaque flag (see TileAtlas) of every tile in the atlas, layout columns,
+    and atlas pixels. Integers are int32 in the byte order of the header.'''
+
+    # Magic, length of JSON header
+    header = struct.Struct('<4sI')
+
+    def __init__(self, layout, atlas):
+        self.layout = layout
+        self.atlas = atlas
+
+    def save(self, filename):
+        atlas = self.atlas
+        layout = self.layout
+        fmt = 'RGBA' if atlas.surface.get_flags() & pygame.SRCALPHA else 'RGB'
+        opaque = atlas.opaque or array.array('i', [0]) * len(atlas)
+        tables = b''.join(column.tobytes() for column in (atlas.x, atlas.y, atlas.width, atlas.height, opaque))
+        # Columns may be NumPy arrays of another integer type
+        columns = b''.join(array.array('i', column).tobytes() for column in layout.columns())
+        sections = [zlib.compress(tables, 9), zlib.compress(columns, 9),
+                    zlib.compress(pygame.image.tostring(atlas.surface, fmt))]
+        header = json.dumps({
+            'version': 1,
+            'byteorder': sys.byteorder,
+            'width': layout.width,
+            'height': layout.height,
+            'tile_width': layout.tile_width,
+            'tile_height': layout.tile_height,
+            'tiles': layout.tiles,
+            'nr_tiles': len(atlas),
+            'nr_cells': len(layout),
+            'atlas': [atlas.surface.get_width(), atlas.surface.get_height(), fmt],
+            'sections': [len(section) for section in sections],
+        }).encode()
+        with open(filename, 'wb') as f:
+            f.write(self.header.pack(b'PYTM', len(header)))
+            f.write(header)
+            for section in sections:
+                f.write(section)
+
+    @classmethod
+    def load(cls, filename):
+        '''Load tile map saved by save()'''
+        with open(filename, 'rb') as f:
+            magic, length = cls.header.unpack(f.read(cls.header.size))
+            if magic != b'PYTM':
+                raise ValueError("'%s' is not a tile map" % filename)
+            header = json.loads(f.read(length))
+            sections = [zlib.decompress(f.read(size)) for size in header['sections']]
+
+        def int_arrays(data, count):
+            values = array.array('i', data)
+            if header['byteorder'] != sys.byteorder:
+                values.byteswap()
+            return [values[i * count:(i + 1) * count] for i in range(len(values) // max(count, 1))]
+
+        width, height, fmt = header['atlas']
+        surface = pygame.image.fromstring(sections[2], (width, height), fmt)
+        atlas = TileAtlas(surface, *int_arrays(sections[0], header['nr_tiles']))
+        if not any(atlas.opaque):
+            atlas.opaque = None
+        layout = Layout(header['width'], header['height'], header['tile_width'],
+                        header['tile_height'], header['tiles'])
+        layout.set_columns(*int_arrays(sections[1], header['nr_cells']))
+        return cls(layout, atlas)
+
+    def render(self, rect=None):
+        '''Return texture, or its region rect, as a new surface. Only the
+        tiles overlapping rect are drawn.'''
+        layout = self.layout
+        rect = pygame.Rect(0, 0, layout.width, layout.height).clip(rect or (0, 0, layout.width, layout.height))
+        if rect.width == 0 or rect.height == 0:
+            raise ValueError("Region is outside of texture")
+        surface = pygame.Surface(rect.size, 0, 32)
+        tile_height = layout.tile_height
+        part = layout.slice(rect.top // tile_height, -(-rect.bottom // tile_height))
+        for row, x, width, index, angle in zip(*part.columns()):
+            if x < rect.right and x + width > rect.left:
+                self.atlas[index].draw_at(surface, x - rect.left, row * tile_height - rect.top,
+                                          width, tile_height, angle)
+        return surface
+
+
+#-------------------------------------------------------------------------------
+class UniformSampler:
+    '''Samples tile indices uniformly, with replacement'''
+
+    def __init__(self, tiles):
+        self.count = len(tiles)
+
+    def sample(self, rng):
+        '''Return one index, drawn with rng (random module or random.Random)'''
+        return rng.randrange(self.count)
+
+    def sample_array(self, count, generator):
+        '''Return an array of count indices, drawn with a NumPy generator'''
+        return generator.integers(0, self.count, count)
+
+
+class ShuffleBagSampler:
+    '''Samples tile indices without replacement: every tile is drawn once
+    before any tile is drawn again'''
+
+    def __init__(self, tiles):
+        self.count = len(tiles)
+        self.bag = []
+        self.queue = None
+
+    def sample(self, rng):
+        '''Return one index, drawn with rng (random module or random.Random)'''
+        if len(self.bag) == 0:
+            self.bag = list(range(self.count))
+        # Swap drawn index with the last one, so removing it is O(1)
+        i = rng.randrange(len(self.bag))
+        self.bag[i], self.bag[-1] = self.bag[-1], self.bag[i]
+        return self.bag.pop()
+
+    def sample_array(self, count, generator):
+        '''Return an array of count indices, drawn with a NumPy generator'''
+        if self.queue is None:
+            self.queue = numpy.zeros(0, numpy.intp)
+        while len(self.queue) < count:
+            self.queue = numpy.concatenate((self.queue, generator.permutation(self.count)))
+        picked = self.queue[:count]
+        self.queue = self.queue[count:]
+        return picked
+
+
+class WeightedSampler:
+    '''Samples tile indices with replacement, proportionally to tiles weight'''
+
+    def __init__(self, tiles):
+        self.cumulative = list(itertools.accumulate(tile.weight for tile in tiles))
+        self.total = self.cumulative[-1] if self.cumulative else 0
+        # Converted once, so that sample_array() is O(log n) per index
+        self.cumulative_array = None if numpy is None else numpy.array(self.cumulative)
+
+    def sample(self, rng):
+        '''Return one index, drawn with rng (random module or random.Random)'''
+        i = bisect.bisect_right(self.cumulative, rng.random() * self.total)
+        return min(i, len(self.cumulative) - 1)
+
+    def sample_array(self, count, generator):
+        '''Return an array of count indices, drawn with a NumPy generator'''
+        indices = numpy.searchsorted(self.cumulative_array, generator.random(count) * self.total, side='right')
+        return numpy.minimum(indices, len(self.cumulative) - 1)
+
+
+samplers = {
+    'uniform': UniformSampler,
+    'bag': ShuffleBagSampler,
+    'weighted': WeightedSampler,
+}
+
+
+#-------------------------------------------------------------------------------
+class Layout:
+    '''Placement of every tile of a texture, independent of tiles pixels.
+    There is one record per placed tile, stored column-wise in compact arrays
+    and sorted by row then x: row of tiles, x position, drawn width (w), tile
+    index and rotation angle in degrees.'''
+
+    fields = ('row', 'x', 'w', 'tile', 'angle')
+
+    def __init__(self, width, height, tile_width, tile_height, tiles=None):
+        self.width = width
+        self.height = height
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        # Tiles filenames, so that tiles can be matched again in prefix mode
+        self.tiles = tiles
+        for name in self.fields:
+            setattr(self, name, array.array('i'))
+
+    def __len__(self):
+        return len(self.row)
+
+    @property
+    def nr_rows(self):
+        return -(-self.height // self.tile_height)
+
+    def append(self, row, x, w, tile, angle):
+        '''Append one placement'''
+        self.row.append(row)
+        self.x.append(x)
+        self.w.append(w)
+        self.tile.append(tile)
+        self.angle.append(angle)
+
+    def columns(self):
+        return [getattr(self, name) for name in self.fields]
+
+    def set_columns(self, *columns):
+        for name, column in zip(self.fields, columns):
+            setattr(self, name, column)
+
+    def arrays(self):
+        '''Return columns as NumPy arrays'''
+        return [numpy.asarray(column, numpy.intp) for column in self.columns()]
+
+    def bounds(self, first_row, last_row):
+        '''Return range of placements in rows first_row to last_row (excluded)'''
+        return bisect.bisect_left(self.row, first_row), bisect.bisect_left(self.row, last_row)
+
+    def slice(self, first_row, last_row):
+        '''Return layout restricted to rows first_row to last_row (excluded)'''
+        start, end = self.bounds(first_row, last_row)
+        layout = Layout(self.width, self.height, self.tile_width, self.tile_height, self.tiles)
+        layout.set_columns(*[column[start:end] for column in self.columns()])
+        return layout
+
+    def scaled(self, tile_width, tile_height):
+        '''Return the same layout for tiles of another size'''
+        sx = tile_width / self.tile_width
+        sy = tile_height / self.tile_height
+        nr_rows = self.nr_rows
+        layout = Layout(round(self.width * sx), min(round(self.height * sy), nr_rows * tile_height),
+                        tile_width, tile_height, self.tiles)
+        current = None
+        next_x = 0
+        for row, x, w, tile, angle in zip(*self.columns()):
+            if row != current:
+                if current is not None and next_x < layout.width:
+                    # Rounding must not leave a gap at end of row
+                    layout.w[-1] += layout.width - next_x
+                current = row
+                next_x = round(x * sx)
+            w = max(1, round(w * sx))
+            layout.append(row, next_x, w, tile, angle)
+            next_x += w
+        if current is not None and next_x < layout.width:
+            layout.w[-1] += layout.width - next_x
+        return layout
+
+    def save(self, filename):
+        '''Save layout as JSON, or as NumPy .npz archive'''
+        header = {
+            'version': 1,
+            'width': self.width,
+            'height': self.height,
+            'tile_width': self.tile_width,
+            'tile_height': self.tile_height,
+            'tiles': self.tiles,
+        }
+        if filename.endswith('.npz'):
+            columns = dict(zip(self.fields, self.arrays()))
+            numpy.savez_compressed(filename, header=json.dumps(header), **columns)
+        else:
+            for name, column in zip(self.fields, self.columns()):
+                header[name] = column.tolist()
+            with open(filename, 'w') as f:
+                json.dump(header, f, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, filename):
+        '''Load layout saved by save()'''
+        if filename.endswith('.npz'):
+            with numpy.load(filename) as data:
+                header = json.loads(str(data['header']))
+                columns = dict((name, data[name].tolist()) for name in cls.fields)
+        else:
+            with open(filename) as f:
+                header = columns = json.load(f)
+        layout = cls(header['width'], header['height'], header['tile_width'],
+                     header['tile_height'], header['tiles'])
+        layout.set_columns(*[array.array('i', columns[name]) for name in cls.fields])
+        return layout
+
+
+#-------------------------------------------------------------------------------
+class TileLoader:
+    '''Loads tiles files lazily. A few files may be decoded ahead of use in
+    a pool of threads, and decoded pixels may be kept in a cache directory,
+    so that next runs do not decode PNG or JPEG files again.'''
+
+    # Cache file header: magic, width, height, pixel format
+    header = struct.Struct('<4sII4s')
+
+    def __init__(self, cache_dir="", threads=0):
+        self.cache_dir = cache_dir
+        self.executor = None
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Tiles waiting to be decoded ahead of use, tiles whose decoding has
+        # started, and number of decoded or decoding tiles not used yet
+        self.queue = collections.deque()
+        self.started = set()
+        self.ahead = 0
+        self.lock = threading.Lock()
+        if threads > 0:
+            self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+            # Bounds decoding of tiles which may never be used
+            self.max_ahead = threads * 2
+
+    def load(self, paths):
+        '''Return tiles for paths. If the loader has threads, a few of them
+        are decoded in the background, more as tiles are used. Others are
+        decoded when first used.'''
+        tiles = [Tile(filename=path, loader=self) for path in paths]
+        if self.executor is not None:
+            with self.lock:
+                self.queue.extend(tiles)
+            self.read_ahead()
+        return tiles
+
+    def read_ahead(self):
+        '''Start decoding queued tiles, until max_ahead tiles are ahead of use'''
+        with self.lock:
+            while self.executor is not None and self.queue and self.ahead < self.max_ahead:
+                tile = self.queue.popleft()
+                if tile not in self.started:
+                    self.started.add(tile)
+                    tile.pending = self.executor.submit(self.decode, tile.filename)
+                    self.ahead += 1
+
+    def get(self, tile):
+        '''Return surface of tile, waiting for its decoding if it is running'''
+        with self.lock:
+            self.started.add(tile)
+            pending, tile.pending = tile.pending, None
+            if pending is not None:
+                self.ahead -= 1
+        self.read_ahead()
+        if pending is not None and not pending.cancel():
+            return pending.result()
+        return self.decode(tile.filename)
+
+    def close(self):
+        '''Stop decoding tiles that have not been used yet'''
+        with self.lock:
+            self.queue.clear()
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+
+    @classmethod
+    def map_file(cls, path, sparse=False):
+        '''Return a surface sharing memory with cache file path, or None if
+        it is not a valid cache file. If only small regions of it will be
+        read, sparse avoids paging in their neighbourhood.'''
+        try:
+            with open(path, 'rb') as f:
+                # Copy-on-write mapping: pixels are paged in from the cache
+                # file when used, and the surface shares memory with it
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            if sparse and hasattr(mmap, 'MADV_RANDOM'):
+                data.madvise(mmap.MADV_RANDOM)
+            magic, width, height, fmt = cls.header.unpack_from(data)
+            if magic == b'PYTL':
+                fmt = fmt.rstrip(b' ').decode()
+                pixels = memoryview(data)[cls.header.size:]
+                return pygame.image.frombuffer(pixels, (width, height), fmt)
+        except (OSError, ValueError, struct.error):
+            pass
+        return None
+
+    def cache_path(self, path):
+        '''Return cache file of path, keyed by its path, mtime and size'''
+        st = os.stat(path)
+        key = "%s:%d:%d" % (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.tile')
+
+    def decode(self, path):
+        '''Decode path, or map its decoded pixels from the cache'''
+        with stats.phase('decode'):
+            return self.decode_file(path)
+
+    def decode_file(self, path):
+        if not self.cache_dir:
+            debug("Load %s" % (path))
+            stats.count('tiles_decoded')
+            return pygame.image.load(path)
+
+        cache_path = self.cache_path(path)
+        surface = self.map_file(cache_path)
+        if surface is not None:
+            stats.count('decode_cache_hits')
+            return surface
+
+        debug("Load %s" % (path))
+        stats.count('tiles_decoded')
+        surface = pygame.image.load(path)
+        fmt = 'RGBA' if surface.get_flags() & pygame.SRCALPHA else 'RGB'
+        tmp_path = "%s.%d.%d" % (cache_path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(self.header.pack(b'PYTL', surface.get_width(), surface.get_height(),
+                                     fmt.ljust(4).encode()))
+            f.write(pygame.image.tostring(surface, fmt))
+        os.replace(tmp_path, cache_path)
+        return surface
+
+
+#-------------------------------------------------------------------------------
+class MemoryCache:
+    '''Keeps values in memory up to a budget of bytes, dropping least
+    recently used ones first'''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # Key -> (value, function returning size of value)
+        self.entries = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, make, size_of):
+        '''Return value of key, made by make() if it is not cached'''
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            stats.count('memory_cache_hits')
+            return entry[0]
+        stats.count('memory_cache_misses')
+        value = make()
+        self.entries[key] = (value, size_of)
+        return value
+
+    def size(self):
+        return sum(size_of(value) for value, size_of in self.entries.values())
+
+    def trim(self):
+        '''Drop values until cache fits in its budget. Sizes are measured
+        again, since tiles keep more transformed variants as they are used.'''
+        size = self.size()
+        while size > self.max_bytes and self.entries:
+            _, (value, size_of) = self.entries.popitem(last=False)
+            size -= size_of(value)
+
+
+def surface_size(surface):
+    return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+
+def tiles_size(tiles):
+    '''Return memory used by decoded tiles and their variants'''
+    size = 0
+    if isinstance(tiles, TileAtlas):
+        size += surface_size(tiles.surface)
+        tiles = tiles.made()
+    for tile in tiles:
+        if tile._surface is not None:
+            size += surface_size(tile._surface)
+        size += tile.variants_bytes
+    return size
+
+
+#-------------------------------------------------------------------------------
+class OutputCache:
+    '''Keeps output files of renders in a directory, one subdirectory per
+    render, named by a hash of everything output depends on (see
+    PyTiler.output_key()). Least recently used renders are removed when
+    the directory grows beyond a budget of bytes.'''
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def fetch(self, key, destination):
+        '''Copy files of render key to destination(name), return False if
+        render key is not cached'''
+        path = os.path.join(self.directory, key)
+        try:
+            names = [name for name in os.listdir(path) if name != 'key.json']
+        except OSError:
+            return False
+        for name in names:
+            # Copied rather than linked: writing output again in place must
+            # not change the cached file
+            target = destination(name)
+            tmp_path = "%s.%d.tmp" % (target, os.getpid())
+            shutil.copyfile(os.path.join(path, name), tmp_path)
+            os.replace(tmp_path, target)
+        # Mark render as recently used
+        os.utime(path)
+        return True
+
+    def store(self, key, files, info):
+        '''Copy files, a dictionary of name: path, as render key described
+        by info, then remove old renders beyond the budget'''
+        tmp_path = tempfile.mkdtemp(prefix='.tmp-', dir=self.directory)
+        for name, source in files.items():
+            shutil.copyfile(source, os.path.join(tmp_path, name))
+        with open(os.path.join(tmp_path, 'key.json'), 'w') as f:
+            json.dump(info, f, indent=1, sort_keys=True)
+        path = os.path.join(self.directory, key)
+        shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Stored meanwhile by another process
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.trim()
+
+    def trim(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                entries.append((os.stat(path).st_mtime, size, path))
+            except OSError:
+                # Removed meanwhile by another process
+                continue
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            debug("Remove cached output %s" % (path))
+            shutil.rmtree(path, ignore_errors=True)
+            size -= entry_size
+
+
+def tool_version():
+    '''Return a hash of this script and of the versions of libraries
+    drawing pixels, so that outputs of other versions are not reused'''
+    with open(os.path.abspath(__file__), 'rb') as f:
+        h = hashlib.sha1(f.read())
+    h.update(pygame.version.ver.encode())
+    if numpy is not None:
+        h.update(numpy.__version__.encode())
+    return h.hexdigest()
+
+
+#-------------------------------------------------------------------------------
+class PngWriter:
+    '''Incremental PNG encoder. Image rows are written band by band as RGB
+    bytes, so the whole image never has to be held in memory.
+
+    With NumPy, every row is filtered with the PNG filter (none, Sub, Up,
+    Average or Paeth) that gives the smallest sum of absolute differences,
+    like libpng does. Without NumPy, rows are stored unfiltered.
+
+    With several threads, bands are compressed in parallel into pieces of
+    the same deflate stream, like pigz does. Each piece is primed with the
+    end of the previous band, so output is barely larger than with one
+    thread.'''
+
+    # Size of the IDAT chunks, independent of the size of the written bands
+    chunk_size = 256 * 1024
+    # Deflate window: how far back a band may refer to previous bands
+    window = 32 * 1024
+    # Rows filtered at once, bounds temporary arrays of filter_rows()
+    filter_rows_max = 64
+
+    def __init__(self, filename, width, height, level=6, threads=1):
+        self.file = open(filename, 'wb')
+        self.width = width
+        self.height = height
+        self.level = level
+        self.pending = b''
+        # Last row written, Up, Average and Paeth filters predict from it
+        self.prior = None
+        # Like libpng, filtered rows are compressed with Z_FILTERED strategy
+        self.strategy = zlib.Z_DEFAULT_STRATEGY if numpy is None else zlib.Z_FILTERED
+        self.executor = None
+        if threads > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+            # Bounds memory held by bands being compressed
+            self.max_pieces = threads * 2
+            self.pieces = collections.deque()
+            self.adler = zlib.adler32(b'')
+            self.previous = b''
+        else:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 15, 8, self.strategy)
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        # 8 bits per channel, RGB, no interlacing
+        self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        if self.executor is not None:
+            # Header of zlib stream
+            self.append(zlib.compress(b'', level)[:2])
+
+    def write_chunk(self, tag, data):
+        self.file.write(struct.pack('>I', len(data)) + tag)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(tag)) & 0xffffffff))
+
+    def append(self, data):
+        '''Append compressed data, writing IDAT chunks once they are full'''
+        self.pending += data
+        if len(self.pending) >= self.chunk_size:
+            view = memoryview(self.pending)
+            end = len(view) - len(view) % self.chunk_size
+            for start in range(0, end, self.chunk_size):
+                self.write_chunk(b'IDAT', view[start:start + self.chunk_size])
+            self.pending = bytes(view[end:])
+
+    def write(self, data):
+        '''Append rows of RGB pixels'''
+        stride = self.width * 3
+        if numpy is None:
+            # Each row starts with its filter type (0: none)
+            rows = b''.join(b'\x00' + data[i:i + stride] for i in range(0, len(data), stride))
+        else:
+            step = stride * self.filter_rows_max
+            rows = b''.join(self.filter_rows(data[i:i + step]) for i in range(0, len(data), step))
+        if self.executor is None:
+            self.append(self.compressor.compress(rows))
+            return
+        self.adler = zlib.adler32(rows, self.adler)
+        self.pieces.append(self.executor.submit(self.compress_piece, rows, self.previous))
+        self.previous = rows[-self.window:]
+        while len(self.pieces) > self.max_pieces:
+            self.append(self.pieces.popleft().result())
+
+    def filter_rows(self, data):
+        '''Return rows of data, each one filtered and prefixed with its
+        filter type'''
+        rows = numpy.frombuffer(data, numpy.uint8).reshape(-1, self.width * 3)
+        # Bytes above (b), on the left (a) and above on the left (c)
+        b = numpy.empty_like(rows)
+        b[0] = 0 if self.prior is None else self.prior
+        b[1:] = rows[:-1]
+        a = numpy.zeros_like(rows)
+        a[:, 3:] = rows[:, :-3]
+        c = numpy.zeros_like(rows)
+        c[:, 3:] = b[:, :-3]
+        # Differences wrap around modulo 256, as PNG filters do
+        filtered = numpy.empty((5,) + rows.shape, numpy.uint8)
+        filtered[0] = rows
+        numpy.subtract(rows, a, out=filtered[1])
+        numpy.subtract(rows, b, out=filtered[2])
+        numpy.subtract(rows, (a >> 1) + (b >> 1) + (a & b & 1), out=filtered[3])
+        a16, b16, c16 = a.astype(numpy.int16), b.astype(numpy.int16), c.astype(numpy.int16)
+        pa, pb, pc = numpy.abs(b16 - c16), numpy.abs(a16 - c16), numpy.abs(a16 + b16 - 2 * c16)
+        numpy.subtract(rows, numpy.where((pa <= pb) & (pa <= pc), a, numpy.where(pb <= pc, b, c)),
+                       out=filtered[4])
+        # Choose filter of smallest sum of differences, taken as signed bytes
+        scores = numpy.abs(filtered.view(numpy.int8)).view(numpy.uint8).sum(axis=2, dtype=numpy.uint32)
+        types = scores.argmin(axis=0)
+        out = numpy.empty((len(rows), rows.shape[1] + 1), numpy.uint8)
+        out[:, 0] = types
+        out[:, 1:] = filtered[types, numpy.arange(len(rows))]
+        self.prior = rows[-1].copy()
+        return out.tobytes()
+
+    def compress_piece(self, rows, previous):
+        '''Return rows as raw deflate blocks, ending on a byte boundary'''
+        if previous:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, 8, self.strategy, previous)
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, 8, self.strategy)
+        return compressor.compress(rows) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def close(self):
+        if self.executor is None:
+            self.append(self.compressor.flush())
+        else:
+            while self.pieces:
+                self.append(self.pieces.popleft().result())
+            self.executor.shutdown()
+            # Empty last block, then checksum of zlib stream
+            self.append(zlib.compressobj(self.level, zlib.DEFLATED, -15).flush())
+            self.append(struct.pack('>I', self.adler & 0xffffffff))
+        self.write_chunk(b'IDAT', self.pending)
+        self.write_chunk(b'IEND', b'')
+        self.file.close()
+
+
+class RawWriter:
+    '''Raw RGB writer: pixels are written as is, without any header'''
+
+    def __init__(self, filename, width, height):
+        self.file = open(filename, 'wb')
+
+    def write(self, data):
+        '''Append rows of RGB pixels'''
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+
+class KtxWriter:
+    '''KTX 1 texture container, with uncompressed RGB mipmap levels written
+    from the largest to the smallest one'''
+
+    identifier = b'\xabKTX 11\xbb\r\n\x1a\n'
+    # Rows are stored top to bottom, not in OpenGL order
+    orientation = b'KTXorientation\x00S=r,T=d\x00\x00'
+
+    def __init__(self, filename, width, height, nr_levels):
+        self.file = open(filename, 'wb')
+        GL_UNSIGNED_BYTE, GL_RGB, GL_RGB8 = 0x1401, 0x1907, 0x8051
+        self.file.write(self.identifier)
+        self.file.write(struct.pack('<13I', 0x04030201, GL_UNSIGNED_BYTE, 1, GL_RGB, GL_RGB8, GL_RGB,
+                                    width, height, 0, 0, 1, nr_levels, 4 + len(self.orientation)))
+        self.file.write(struct.pack('<I', len(self.orientation) - 1))
+        self.file.write(self.orientation)
+
+    def write_level(self, data, width, height):
+        '''Append a whole level, as rows of RGB pixels'''
+        stride = width * 3
+        # Rows are aligned on 4 bytes
+        padding = b'\x00' * (-stride % 4)
+        if padding:
+            data = b''.join(data[i:i + stride] + padding for i in range(0, len(data), stride))
+        self.file.write(struct.pack('<I', len(data)))
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+
+def surface_bytes(surface):
+    '''Return pixels of surface as a (height, pitch) array of bytes sharing
+    memory with it. Surface is locked until the array is deleted.'''
+    pixels = numpy.asarray(surface.get_buffer())
+    return pixels.reshape(surface.get_height(), surface.get_pitch())
+
+
+def box_weights(size, new_size):
+    '''Return (indices, weights) arrays of shape (new_size, taps): the source
+    pixels averaged into each pixel when size pixels are shrunk to new_size
+    with a box filter. Output pixels partition source pixels exactly, so a
+    texture which wraps seamlessly still does once shrunk.'''
+    scale = size / new_size
+    starts = numpy.arange(new_size) * scale
+    taps = int(numpy.ceil(scale)) + 1
+    indices = numpy.floor(starts).astype(numpy.intp)[:, numpy.newaxis] + numpy.arange(taps)
+    overlap = numpy.minimum(starts[:, numpy.newaxis] + scale, indices + 1) - \
+              numpy.maximum(starts[:, numpy.newaxis], indices)
+    weights = numpy.clip(overlap, 0, None) / scale
+    # Drop taps which never contribute
+    used = weights.any(axis=0)
+    return numpy.minimum(indices[:, used], size - 1), weights[:, used].astype(numpy.float32)
+
+
+def shrink_pixels(pixels, width, height):
+    '''Shrink (w, h, channels) pixels to width x height with a box filter.
+    Output rows are computed by bands, to bound temporary memory.'''
+    if pixels.shape[:2] == (width * 2, height * 2):
+        # Usual case of even sizes: sum 2x2 blocks with integers
+        sums = pixels[0::2, 0::2].astype(numpy.uint16)
+        sums += pixels[1::2, 0::2]
+        sums += pixels[0::2, 1::2]
+        sums += pixels[1::2, 1::2]
+        sums += 2
+        sums >>= 2
+        return sums.astype(numpy.uint8)
+    ix, wx = box_weights(pixels.shape[0], width)
+    iy, wy = box_weights(pixels.shape[1], height)
+    shrunk = numpy.empty((width, height, pixels.shape[2]), numpy.uint8)
+    band_rows = 64
+    for y in range(0, height, band_rows):
+        rows_y, rows_w = iy[y:y + band_rows], wy[y:y + band_rows]
+        first, last = rows_y.min(), rows_y.max() + 1
+        source = pixels[:, first:last]
+        columns = sum(source[ix[:, k]] * wx[:, k, numpy.newaxis, numpy.newaxis]
+                      for k in range(ix.shape[1]))
+        band = sum(columns[:, rows_y[:, k] - first] * rows_w[:, k, numpy.newaxis]
+                   for k in range(iy.shape[1]))
+        shrunk[:, y:y + band_rows] = numpy.clip(numpy.rint(band), 0, 255)
+    return shrunk
+
+
+def save_surface(surface, filename, level=6, threads=1):
+    '''Save surface, by bands for formats written by PyTiler itself'''
+    width, height = surface.get_size()
+    if numpy is None and level == 6 and os.path.splitext(filename)[1].lower() == '.png':
+        # Without NumPy, PngWriter does not filter rows and pygame writes
+        # smaller files
+        pygame.image.save(surface, filename)
+        return
+    writer = open_writer(filename, width, height, level, threads)
+    if writer is None:
+        pygame.image.save(surface, filename)
+        return
+    for y in range(0, height, 256):
+        rect = pygame.Rect(0, y, width, min(256, height - y))
+        writer.write(pygame.image.tostring(surface.subsurface(rect), 'RGB'))
+    writer.close()
+
+
+def open_writer(filename, width, height, level=6, threads=1):
+    '''Return a band writer for filename, or None if its format can only be
+    written in one go by pygame. PNG is compressed at zlib level, by
+    threads.'''
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.png':
+        return PngWriter(filename, width, height, level, threads)
+    elif ext in ('.raw', '.rgb'):
+        return RawWriter(filename, width, height)
+    return None
+
+
+class BackgroundSaver:
+    '''Runs saves in a background thread, one after the other, so that the
+    caller goes on meanwhile. Each save is reported as soon as it ends.'''
+
+    def __init__(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.futures = []
+
+    def submit(self, save, message):
+        '''Run save() then print message, or the error of save()'''
+        def run():
+            try:
+                save()
+            except Exception as e:
+                error(e)
+                return False
+            print(message)
+            return True
+
+        self.futures = [future for future in self.futures if not future.done()]
+        self.futures.append(self.executor.submit(run))
+
+    def wait(self):
+        '''Wait for submitted saves, return False if one of them failed'''
+        futures, self.futures = self.futures, []
+        return all([future.result() for future in futures])
+
+    def close(self):
+        '''Wait for submitted saves and stop thread, return False if one of
+        them failed'''
+        try:
+            return self.wait()
+        finally:
+            self.executor.shutdown()
+
+
+#-------------------------------------------------------------------------------
+class FrameProducer:
+    '''Renders frames of a PyTiler in a background thread, for demo mode.
+    Frames alternate between two offscreen buffers: the next frame is
+    rendered in one of them while the other one is shown.'''
+
+    # Posted when a frame is ready to be shown
+    FRAME_READY = pygame.USEREVENT + 1
+
+    def __init__(self, tiler, display):
+        self.tiler = tiler
+        self.buffers = [display.copy(), display.copy()]
+        # Rendered (surface, layout) waiting to be shown
+        self.ready = None
+        self.error = None
+        self.running = True
+        # Names of tiler options to toggle before next frame
+        self.toggles = []
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        back = 0
+        while True:
+            with self.condition:
+                while self.running and self.ready is not None:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                # Options only change between frames, so that every row of
+                # a frame is planned with the same ones
+                for name in self.toggles:
+                    setattr(self.tiler, name, not getattr(self.tiler, name))
+                self.toggles = []
+            surface = self.buffers[back]
+            try:
+                surface.fill(pygame.Color('#00000000'))
+                layout = self.tiler.plan()
+                self.tiler.rasterize(layout, surface)
+            except Exception as e:
+                self.error = e
+                pygame.event.post(pygame.event.Event(self.FRAME_READY))
+                return
+            with self.condition:
+                self.ready = surface, layout
+            pygame.event.post(pygame.event.Event(self.FRAME_READY))
+            back = 1 - back
+
+    def toggle(self, name):
+        '''Toggle tiler option name before next frame is planned'''
+        with self.condition:
+            self.toggles.append(name)
+
+    def present(self, display):
+        '''Copy ready frame to display, and return its layout'''
+        with self.condition:
+            surface, layout = self.ready
+            self.ready = None
+            # Next frame is rendered in the other buffer meanwhile
+            self.condition.notify()
+        display.blit(surface, (0, 0))
+        return layout
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
 
 
 #-------------------------------------------------------------------------------
 class PyTiler:
     '''PyTiler Main class'''
 
+    # Attributes set from command line options
+    options = ('auto', 'nr_tiles', 'filename', 'prefix', 'rotate', 'brick',
+               'demo', 'seed', 'tile_width', 'tile_height', 'random_width',
+               'width', 'height', 'border', 'border_shade', 'outfilename',
+               'remove_after_use', 'render_only', 'stream', 'engine', 'jobs',
+               'cache_dir', 'load_threads', 'sampler', 'weights',
+               'layout_file', 'layout_out', 'verbose', 'profile', 'stats_json',
+               'mipmaps', 'serve', 'socket', 'cache_mb', 'batch',
+               'output_cache', 'output_cache_mb', 'no_output_cache', 'from_tilemap',
+               'region', 'png_level', 'encode_threads')
+
+    # Options which do not change output, or whose files are hashed
+    # instead of their names by output_key(). jobs is one of them only
+    # because plan() draws every row from its own generator.
+    not_output_options = ('demo', 'jobs', 'cache_dir', 'load_threads', 'verbose',
+                          'profile', 'stats_json', 'serve', 'socket', 'cache_mb',
+                          'batch', 'output_cache', 'output_cache_mb', 'no_output_cache',
+                          'filename', 'outfilename', 'layout_file', 'layout_out', 'weights',
+                          'from_tilemap', 'encode_threads')
+
     def __init__(self):
         self.display = None
         self.auto = False
@@ -72,13 +1266,74 @@ class PyTiler:
         self.border_shade = 64
         self.outfilename = "out.png"
         self.remove_after_use = False
+        self.sampler = 'uniform'
+        self.weights = ""
+        self.tile_sampler = None
+        # Number of layouts planned, so that every frame of a window differs
+        self.frame = 0
+        self.layout_file = ""
+        self.layout_out = ""
+        self.layout_in = None
+        self.layout = None
+        self.render_only = False
+        self.stream = False
+        self.engine = 'pygame'
+        self.jobs = 0
+        self.cache_dir = ""
+        self.load_threads = os.cpu_count() or 1
+        self.loader = None
+        self.rng = None
+        self.atlas = None
+        self.atlas_key = None
+        self.atlas_tiles = None
         self.tiles = []
-        self.tiles_trash = []
+        self.verbose = False
+        self.profile = ""
+        self.stats_json = ""
+        self.mipmaps = ""
+        self.serve = False
+        self.socket = ""
+        self.cache_mb = 1024
+        self.batch = ""
+        self.output_cache = ""
+        self.output_cache_mb = 1024
+        self.no_output_cache = False
+        self.from_tilemap = ""
+        self.region = ""
+        self.png_level = 6
+        self.encode_threads = os.cpu_count() or 1
+        # Saves output in the background, if set
+        self.saver = None
+        # Key of output in output cache, if it is to be stored there
+        self.output_cache_key = None
+        # Sources and tiles kept between jobs of a RenderServer
+        self.memory_cache = None
 
     def __str__(self):
         s = ""
         return s
 
+    def get_options(self):
+        '''Return options as a dictionary'''
+        return dict((name, getattr(self, name)) for name in self.options)
+
+    def convert_option(self, name, value):
+        '''Return value of option name converted from a string, to the type
+        of its current value'''
+        current = getattr(self, name, None)
+        if not isinstance(value, str) or current is None or isinstance(current, str):
+            return value
+        if isinstance(current, bool):
+            return value.lower() in ('1', 'true', 'yes', 'on')
+        return type(current)(value)
+
+    def set_options(self, options):
+        '''Set options from a dictionary'''
+        for name, value in options.items():
+            if name not in self.options:
+                raise ValueError("Unknown option '%s'" % name)
+            setattr(self, name, value)
+
     def usage(self):
         print("Usage: " +  os.path.basename(sys.argv[0]) + \
               " -w width -h height -o filename -p tile-prefix -s seed -r")
@@ -90,27 +1345,87 @@ class PyTiler:
         print("  -h height          Output texture height")
         print("  -H height          Individual tile height")
         print("  -n num             Number of tiles to generate")
-        print("  -o filename        Output filename")
+        print("  -o filename        Output filename. A .tilemap output is the atlas of tiles")
+        print("                     and their layout, instead of pixels (see TileMap)")
         print("  -p prefix          Prefix of tiles files")
         print("  -r                 Randomly rotate tiles by 90 degree increment")
         print("  -s                 Random seed")
+        print("  -v, --verbose      Also print progress of every tile and row")
         print("  -w width           Output texture width")
         print("  -W width           Individual tile width")
         print("  --brick            Use brick pattern")
         print("  --border=num       Tiles border width")
         print("  --border-shade=num Border shade (0..255) (greater values give darker border)")
+        print("  --cache-dir=dir    Keep decoded tiles files in dir, to skip decoding next time")
+        print("                     In auto mode, the input texture is kept decoded too, and")
+        print("                     next runs only read the regions cut into tiles")
+        print("  --encode-threads=num    Threads compressing PNG output (default: number of")
+        print("                     CPUs)")
+        print("  --engine=name      Compositing engine: pygame (default) or numpy")
+        print("  --jobs=num         Render bands of rows in num processes (with --render-only")
+        print("                     or --stream). Output does not depend on num")
+        print("  --layout=filename  Render layout saved with --save-layout instead of choosing")
+        print("                     tiles. It is scaled to the -W/-H tile size")
+        print("  --load-threads=num Number of threads decoding tiles files ahead of use, at")
+        print("                     most two files per thread ahead (default: number of")
+        print("                     CPUs, 0: decode tiles when first used)")
+        print("  --png-level=num    PNG compression level, from 0 (fastest, uncompressed) to 9")
+        print("                     (smallest) (default: 6). Use .raw output for raw RGB pixels.")
+        print("                     Rows are filtered like libpng does, so level 6 files are")
+        print("                     the size of pygame ones. Level 1 is about twice as fast,")
+        print("                     for files about 15% larger")
+        print("  --profile=filename Save cProfile stats of the main thread into filename")
+        print("  --mipmaps=levels   Also save mipmap levels shrunk from output, as")
+        print("                     name.mipN.ext files, or in output file if it is .ktx:")
+        print("                     'all', or levels like '1-3' or '1,2,4' (0 is output)")
         print("  --rand-width       Random tile width")
         print("  --remove-after-use Remove tile from list after is has been used once")
         print("                     This makes sure every tile has been used before reusing one")
+        print("  --sampler=name     How tiles are drawn: uniform (default), bag (same as")
+        print("                     --remove-after-use) or weighted (see --weights)")
+        print("  --weights=filename File of 'tile-filename weight' lines, for weighted sampler")
+        print("  --save-layout=filename  Save layout of tiles with output (.json or .npz)")
+        print("  --stats-json=filename   Save time spent in each phase (decode, extract,")
+        print("                     border, layout, compose, flip, save) and counters of")
+        print("                     placed tiles, transforms and cache hits as JSON")
+        print("  --render-only      Render output file without opening a window, then exit")
+        print("  --serve            Run render jobs read as JSON lines on standard input, like")
+        print("                     {\"id\": 1, \"args\": [\"-a\", \"-f\", \"in.png\", \"-o\", \"out.png\"]}")
+        print("                     and answer each one with a JSON line on standard output.")
+        print("                     Sources and tiles are kept in memory between jobs")
+        print("  --socket=path      Like --serve, but read jobs from a Unix socket")
+        print("  --cache-mb=num     Memory budget of --serve and --socket caches (default: 1024)")
+        print("  --batch=manifest   Run every job of a JSON or CSV manifest (see BatchRunner)")
+        print("                     in --jobs processes (default: number of CPUs). Results are")
+        print("                     appended to manifest.results.jsonl, and jobs done")
+        print("                     already are skipped when the batch is run again.")
+        print("                     --jobs of manifest jobs is ignored")
+        print("  --output-cache=dir Keep outputs of --render-only and --stream in dir, and")
+        print("                     copy them instead of rendering when the same options,")
+        print("                     -S seed and input files are given again")
+        print("  --output-cache-mb=num   Size of output cache (default: 1024)")
+        print("  --no-output-cache  Render even if output is cached, then replace it")
+        print("  --from-tilemap=filename  Render a .tilemap file into output")
+        print("  --region=x,y,w,h   Only render this region of --from-tilemap")
+        print("  --stream           Like --render-only, but render and write output one row")
+        print("                     of tiles at a time (PNG or raw RGB output only)")
 
-    def parse_args(self):
+    def parse_args(self, argv=None):
+        if argv is None:
+            argv = sys.argv[1:]
         try:
-            opts, args = getopt.getopt(sys.argv[1:], "abf:h:H:n:o:p:rs:S:w:W:",
-                                       ["demo", "brick", "border=", "border-shade=", "rand-width", "remove-after-use"])
+            opts, args = getopt.getopt(argv, "abf:h:H:n:o:p:rs:S:vw:W:",
+                                       ["demo", "brick", "border=", "border-shade=", "rand-width", "remove-after-use",
+                                        "render-only", "stream", "engine=", "jobs=",
+                                        "cache-dir=", "load-threads=", "sampler=", "weights=",
+                                        "layout=", "save-layout=", "verbose", "profile=", "stats-json=",
+                                        "mipmaps=", "serve", "socket=", "cache-mb=", "batch=",
+                                        "output-cache=", "output-cache-mb=", "no-output-cache",
+                                        "from-tilemap=", "region=", "png-level=", "encode-threads="])
         except getopt.GetoptError as err:
             error(str(err))
             self.usage()
-            exit(1)
+            sys.exit(1)
 
         for o, a in opts:
             if o == "-a":
@@ -133,6 +1448,8 @@ class PyTiler:
                 self.tile_height = self.tile_width = int(a)
             elif o == "-S":
                 self.seed = int(a)
+            elif o == "-v" or o == "--verbose":
+                self.verbose = True
             elif o == "-w":
                 self.width = int(a)
             elif o == "-W":
@@ -150,64 +1467,461 @@ class PyTiler:
                 else:
                     error(("Invalid border shade %d") % (shade))
                     self.usage()
-                    exit(1)
+                    sys.exit(1)
             elif o == "--rand-width":
                 self.random_width = True
             elif o == "--remove-after-use":
                 self.remove_after_use = True
+            elif o == "--sampler":
+                if a not in samplers:
+                    error(("Invalid sampler '%s'") % (a))
+                    self.usage()
+                    sys.exit(1)
+                self.sampler = a
+            elif o == "--weights":
+                self.weights = a
+            elif o == "--layout":
+                self.layout_file = a
+            elif o == "--save-layout":
+                self.layout_out = a
+            elif o == "--mipmaps":
+                self.mipmaps = a
+                try:
+                    self.mipmap_levels()
+                except ValueError:
+                    error(("Invalid mipmap levels '%s'") % (a))
+                    self.usage()
+                    sys.exit(1)
+            elif o == "--profile":
+                self.profile = a
+            elif o == "--stats-json":
+                self.stats_json = a
+            elif o == "--serve":
+                self.serve = True
+            elif o == "--socket":
+                self.socket = a
+            elif o == "--cache-mb":
+                self.cache_mb = int(a)
+            elif o == "--batch":
+                self.batch = a
+            elif o == "--output-cache":
+                self.output_cache = a
+            elif o == "--output-cache-mb":
+                self.output_cache_mb = int(a)
+            elif o == "--no-output-cache":
+                self.no_output_cache = True
+            elif o == "--png-level":
+                level = int(a)
+                if 0 <= level <= 9:
+                    self.png_level = level
+                else:
+                    error(("Invalid PNG level %d") % (level))
+                    self.usage()
+                    sys.exit(1)
+            elif o == "--encode-threads":
+                self.encode_threads = max(1, int(a))
+            elif o == "--from-tilemap":
+                self.from_tilemap = a
+            elif o == "--region":
+                self.region = a
+                try:
+                    self.region_rect()
+                except ValueError:
+                    error(("Invalid region '%s'") % (a))
+                    self.usage()
+                    sys.exit(1)
+            elif o == "--render-only":
+                self.render_only = True
+            elif o == "--stream":
+                self.stream = True
+            elif o == "--cache-dir":
+                self.cache_dir = a
+            elif o == "--load-threads":
+                self.load_threads = int(a)
+            elif o == "--jobs":
+                self.jobs = int(a)
+            elif o == "--engine":
+                if a not in ('pygame', 'numpy'):
+                    error(("Invalid engine '%s'") % (a))
+                    self.usage()
+                    sys.exit(1)
+                if a == 'numpy' and numpy is None:
+                    error("NumPy is required by numpy engine")
+                    sys.exit(1)
+                self.engine = a
 
-    def run(self):
-        """Initialize and run infinite event loop"""
+    def init_seed(self):
+        '''Choose random seed if none has been given and seed generator'''
         if self.seed == 0:
             self.seed = random.randrange(sys.maxsize)
         random.seed(self.seed)
+        if numpy is not None:
+            self.rng = numpy.random.default_rng(self.seed)
 
         print("Random Seed: %d" % self.seed)
 
-        pygame.key.set_repeat(100, 100)
-
-        # Load or create tiles
+    def load_tiles(self):
+        '''Load tiles files or create tiles from input texture'''
+        self.tiles = []
         if self.auto is False:
-            for path in os.listdir('.'):
-                if os.path.isfile(path) and \
-                   path.startswith(self.prefix) and \
-                   (path.endswith('.png') or path.endswith('.jpg')):
-                    self.tiles.append(Tile(filename=path))
+            paths = self.tile_paths()
+            if self.loader is not None:
+                self.loader.close()
+            self.loader = TileLoader(self.cache_dir, self.load_threads)
+            if self.memory_cache is not None:
+                files = tuple((path, os.stat(path).st_mtime_ns) for path in sorted(paths))
+                key = ('prefix', os.getcwd(), self.cache_dir, files)
+                self.tiles = self.memory_cache.get(key, lambda: self.loader.load(paths), tiles_size)
+            else:
+                self.tiles = self.loader.load(paths)
             print("%d tiles loaded" % (len(self.tiles)))
         else:
             if not os.path.isfile(self.filename):
                 error(("No file '%s' found") % (self.filename))
                 sys.exit(1)
-            surface = pygame.image.load(self.filename)
+            if self.memory_cache is not None:
+                self.tiles = self.cached_tiles()
+            else:
+                surface = self.load_source()
+                with stats.phase('extract'):
+                    self.tiles = self.extract_tiles(surface)
+
+        if self.weights:
+            self.load_weights()
+        self.tile_sampler = self.make_sampler()
+        if self.layout_file:
+            self.load_layout()
+
+    def tile_paths(self):
+        '''Return tiles files of prefix mode'''
+        paths = []
+        for path in os.listdir('.'):
+            if os.path.isfile(path) and \
+               path.startswith(self.prefix) and \
+               (path.endswith('.png') or path.endswith('.jpg')):
+                paths.append(path)
+        return paths
+
+    def load_source(self):
+        '''Return source texture of auto mode.
+        A source decoded into cache_dir by a previous run, or a .tile file
+        in the same format, is memory mapped rather than read: only pages
+        of the regions cut into tiles are loaded, so memory use depends on
+        the number of tiles, not on the size of the source.'''
+        if self.filename.endswith('.tile'):
+            surface = TileLoader.map_file(self.filename, sparse=True)
+            if surface is None:
+                error(("Invalid tile file '%s'") % (self.filename))
+                sys.exit(1)
+            return surface
+        if self.cache_dir:
+            loader = TileLoader(self.cache_dir)
+            surface = loader.map_file(loader.cache_path(self.filename), sparse=True)
+            if surface is not None:
+                stats.count('decode_cache_hits')
+                return surface
+            return loader.decode(self.filename)
+        with stats.phase('decode'):
+            return pygame.image.load(self.filename)
+
+    def cached_tiles(self):
+        '''Return tiles of auto mode from memory cache, if a previous job cut
+        the same tiles out of the same source, else cut them and cache them'''
+        st = os.stat(self.filename)
+        source_key = ('source', os.path.abspath(self.filename), st.st_mtime_ns, st.st_size)
+        key = ('tiles', source_key, self.seed, self.nr_tiles, self.tile_width, self.tile_height,
+               self.random_width, self.border, self.border_shade)
+
+        def extract():
+            surface = self.memory_cache.get(source_key, self.load_source, surface_size)
+            with stats.phase('extract'):
+                return self.extract_tiles(surface), surface.get_size()
+
+        cached = key in self.memory_cache
+        tiles, size = self.memory_cache.get(key, extract, lambda value: tiles_size(value[0]))
+        if cached:
+            # Draw the same random numbers as extraction, so that the rest of
+            # the output is the same as without cache
+            self.sample_crops(*size)
+        return tiles
+
+    def load_weights(self):
+        '''Set tiles weight from weights file'''
+        weights = {}
+        with open(self.weights) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2:
+                    weights[fields[0]] = float(fields[1])
+        for tile in self.tiles:
+            tile.weight = weights.get(tile.filename, 1.0)
+
+    def make_sampler(self):
+        '''Return a new sampler of tiles indices'''
+        if self.remove_after_use:
+            return ShuffleBagSampler(self.tiles)
+        return samplers[self.sampler](self.tiles)
+
+    def sample_crops(self, width, height):
+        '''Choose position and width of every tile cut out of a source of
+        the given size'''
+        crops = []
+        for i in range(0, self.nr_tiles):
+            x = random.randrange(0, width - self.tile_width)
+            y = random.randrange(0, height - self.tile_height)
+            if self.random_width:
+                tile_width = random.randrange(self.tile_width // 2, self.tile_width)
+            else:
+                tile_width = self.tile_width
+            crops.append((x, y, tile_width))
+        return crops
+
+    def border_surface(self, tile_width):
+        '''Return border to be subtracted from tiles of the given width'''
+        border_surf = pygame.Surface((tile_width, self.tile_height), pygame.SRCALPHA)
+        border_surf.fill((0, 0, 0, 0))
+        if self.border < 4:
+            #col = (16, 16, 16) # Good for wood floor
+            col = (self.border_shade, self.border_shade, self.border_shade)
+            pygame.draw.line(border_surf, col, (0, 0), (tile_width-1, 0), self.border)
+            pygame.draw.line(border_surf, col, (0, 0), (0, self.tile_height-1), self.border)
+        else:
+            col = (self.border_shade, self.border_shade, self.border_shade)
+            pygame.draw.rect(border_surf, col, (0, 0, tile_width, self.tile_height), self.border)
+            col = (min(self.border_shade+32, 255), min(self.border_shade+32, 255), min(self.border_shade+32, 255))
+            pygame.draw.rect(border_surf, col, (0, 0, tile_width, self.tile_height), 1)
+        return border_surf
+
+    def extract_tile(self, surface, crop):
+        '''Cut one tile out of surface and apply its border'''
+        x, y, tile_width = crop
+        subsurface = surface.subsurface(pygame.Rect(x, y, tile_width, self.tile_height)).copy()
+        if self.border > 0:
+            r = pygame.Rect(0, 0, tile_width, self.tile_height)
+            with stats.phase('border'):
+                subsurface.blit(self.border_surface(tile_width), r, special_flags=pygame.BLEND_RGBA_SUB)
+        return Tile(surface=subsurface)
+
+    def extract_tiles(self, surface):
+        '''Cut nr_tiles tiles out of surface, into a TileAtlas.
+        Tiles are copied as raw pixel bytes of surface, and the border is
+        subtracted from the whole atlas at once, so no border is drawn and
+        blended per tile.'''
+        crops = self.sample_crops(*surface.get_size())
+        if numpy is None or surface.get_bytesize() < 3:
+            return [self.extract_tile(surface, crop) for crop in crops]
+
+        bpp = surface.get_bytesize()
+        height = self.tile_height
+        atlas = TileAtlas.pack([crop[2] for crop in crops], [height] * len(crops), surface)
+        source = surface_bytes(surface)
+        pixels = surface_bytes(atlas.surface)
+        for (x, y, width), atlas_x, atlas_y in zip(crops, atlas.x, atlas.y):
+            pixels[atlas_y:atlas_y + height, atlas_x * bpp:(atlas_x + width) * bpp] = \
+                source[y:y + height, x * bpp:(x + width) * bpp]
+        del source
+
+        if self.border > 0:
+            with stats.phase('border'):
+                # Border of every row of the atlas, made once per sequence of
+                # tiles widths: all rows but the last are alike, unless tiles
+                # have random widths
+                masks = {}
+                mask_widths = None
+                for atlas_y, widths in atlas.rows():
+                    if widths != mask_widths:
+                        for width in widths:
+                            if width not in masks:
+                                masks[width] = self.border_mask(surface, width)
+                        mask = numpy.concatenate([masks[width] for width in widths], axis=1)
+                        mask_widths = widths
+                    row = pixels[atlas_y:atlas_y + height, :mask.shape[1]]
+                    # Subtracting byte by byte is the same as a BLEND_RGBA_SUB blit
+                    numpy.maximum(row, mask, out=row)
+                    row -= mask
+        del pixels
+        return atlas
+
+    def border_mask(self, surface, tile_width):
+        '''Return border of tiles of the given width as raw bytes, with the
+        pixel format of surface'''
+        mask_surf = pygame.Surface((tile_width, self.tile_height), surface.get_flags() & pygame.SRCALPHA,
+                                   surface.get_bitsize(), surface.get_masks())
+        mask_surf.fill((0, 0, 0, 0))
+        mask_surf.blit(self.border_surface(tile_width), (0, 0), special_flags=pygame.BLEND_RGBA_MAX)
+        return surface_bytes(mask_surf)[:, :tile_width * surface.get_bytesize()].copy()
+
+    def render(self):
+        '''Draw tiles into an offscreen surface and return it.
+        No window is opened, so output size is not limited by the screen.'''
+        if len(self.tiles) == 0:
+            self.init_seed()
+            self.load_tiles()
+        self.display = pygame.Surface((self.width, self.height), 0, 32)
+        if self.jobs > 0:
+            for y, data in self.render_bands():
+                band = pygame.image.fromstring(data, (self.width, len(data) // (self.width * 3)), 'RGB')
+                self.display.blit(band, (0, y))
+        else:
+            self.draw()
+        return self.display
+
+    def run(self):
+        """Initialize and run infinite event loop"""
+        global verbose
+        verbose = self.verbose
+        stats.reset()
+        profiler = None
+        if self.profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
 
-            for i in range(0, self.nr_tiles):
-                x = random.randrange(0, surface.get_width() - self.tile_width)
-                y = random.randrange(0, surface.get_height() - self.tile_height)
-                if self.random_width:
-                    tile_width = random.randrange(self.tile_width/2, self.tile_width)
+        try:
+            if self.batch:
+                BatchRunner(self.batch, self.jobs or os.cpu_count() or 1, self.cache_mb).run()
+                return
+            if self.serve or self.socket:
+                server = RenderServer(self.cache_mb)
+                if self.socket:
+                    server.serve_socket(self.socket)
                 else:
-                    tile_width = self.tile_width
-                print(tile_width)
-                subsurface = surface.subsurface(pygame.Rect(x, y, tile_width, self.tile_height)).copy()
-                if self.border > 0:
-                    r = pygame.Rect(0, 0, tile_width, self.tile_height)
-                    border_surf = pygame.Surface((tile_width, self.tile_height), pygame.SRCALPHA)
-                    border_surf.fill((0, 0, 0, 0))
-                    if self.border < 4:
-                        border_surf.fill((0, 0, 0, 0))
-                        #col = (16, 16, 16) # Good for wood floor
-                        col = (self.border_shade, self.border_shade, self.border_shade)
-                        pygame.draw.line(border_surf, col, (0, 0), (tile_width-1, 0), self.border)
-                        pygame.draw.line(border_surf, col, (0, 0), (0, self.tile_height-1), self.border)
-                        subsurface.blit(border_surf, r, special_flags=pygame.BLEND_RGBA_SUB)
-                    else:
-                        col = (self.border_shade, self.border_shade, self.border_shade)
-                        pygame.draw.rect(border_surf, col, (0, 0, tile_width, self.tile_height), self.border)
-                        col = (min(self.border_shade+32, 255), min(self.border_shade+32, 255), min(self.border_shade+32, 255))
-                        pygame.draw.rect(border_surf, col, (0, 0, tile_width, self.tile_height), 1)
-                        #subsurface.blit(border_surf, r)
-                        subsurface.blit(border_surf, r, special_flags=pygame.BLEND_RGBA_SUB)
-                self.tiles.append(Tile(surface=subsurface))
+                    server.serve(sys.stdin)
+                return
+
+            if self.fetch_output():
+                return
+            if self.from_tilemap:
+                self.render_tilemap()
+                return
+
+            self.init_seed()
+
+            # Load or create tiles
+            self.load_tiles()
+
+            if self.stream or self.render_only:
+                self.render_output()
+            else:
+                # Saving does not freeze the window
+                self.saver = BackgroundSaver()
+                try:
+                    self.loop()
+                finally:
+                    self.saver.close()
+                    self.saver = None
+        finally:
+            if self.loader is not None:
+                self.loader.close()
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(self.profile)
+                print("Saved profile into " + self.profile)
+            if self.stats_json:
+                stats.save(self.stats_json)
+                print("Saved stats into " + self.stats_json)
+
+    def render_output(self):
+        '''Render and save output file, without opening a window'''
+        if self.tilemap_output():
+            # Pixels are not needed
+            self.layout = self.plan()
+            self.save()
+        elif self.stream:
+            writer = open_writer(self.outfilename, self.width, self.height, self.png_level,
+                                 self.encode_threads)
+            if writer is None:
+                error("Only PNG and raw output can be streamed")
+                sys.exit(1)
+            if self.mipmaps:
+                error("Mipmaps are shrunk from whole output, use --render-only")
+                sys.exit(1)
+            self.render_strips(writer)
+            print("Saved tiles into " + self.outfilename)
+            self.save_layout()
+        else:
+            self.render()
+            # Output is encoded while mipmaps are shrunk
+            self.saver = BackgroundSaver()
+            try:
+                self.save()
+            finally:
+                saved = self.saver.close()
+                self.saver = None
+            if not saved:
+                sys.exit(1)
+        self.store_output()
+
+    def output_key(self):
+        '''Return hash of what output depends on, and its description, or
+        None if an input file is missing'''
+        options = self.get_options()
+        for name in self.not_output_options:
+            del options[name]
+        # Output files are named after outfilename and layout_out, but
+        # only their formats change them
+        options['output_format'] = os.path.splitext(self.outfilename)[1].lower()
+        options['layout_format'] = os.path.splitext(self.layout_out)[1].lower()
+        paths = [self.filename] if self.auto else sorted(self.tile_paths())
+        paths += [path for path in (self.weights, self.layout_file, self.from_tilemap) if path]
+        inputs = []
+        try:
+            for path in paths:
+                st = os.stat(path)
+                inputs.append([os.path.abspath(path), st.st_size, st.st_mtime_ns])
+        except OSError:
+            return None
+        info = {'version': tool_version(), 'options': options, 'inputs': inputs}
+        return hashlib.sha256(json.dumps(info, sort_keys=True).encode()).hexdigest(), info
+
+    def output_files(self):
+        '''Return files written by render_output(), as a dictionary of
+        name in output cache: path'''
+        root, ext = os.path.splitext(self.outfilename)
+        files = {'output' + ext: self.outfilename}
+        if ext.lower() != '.ktx' and not self.stream:
+            for level in self.mipmap_levels():
+                files['output.mip%d%s' % (level, ext)] = "%s.mip%d%s" % (root, level, ext)
+        if self.layout_out and self.layout is not None:
+            files['layout' + os.path.splitext(self.layout_out)[1]] = self.layout_out
+        return files
+
+    def fetch_output(self):
+        '''Copy output files from output cache if they were rendered with the
+        same options, seed and inputs, and return True. Random seeds are
+        not cached.'''
+        if not self.output_cache or self.seed == 0 or not (self.stream or self.render_only):
+            return False
+        key = self.output_key()
+        if key is None:
+            return False
+        self.output_cache_key = key
+        if self.no_output_cache:
+            return False
+        root = os.path.splitext(self.outfilename)[0]
+
+        def destination(name):
+            if name.startswith('layout'):
+                return self.layout_out
+            return root + name[len('output'):]
+
+        cache = OutputCache(self.output_cache, self.output_cache_mb << 20)
+        if not cache.fetch(key[0], destination):
+            stats.count('output_cache_misses')
+            return False
+        stats.count('output_cache_hits')
+        print("Copied cached output into " + self.outfilename)
+        return True
+
+    def store_output(self):
+        '''Keep output files in output cache, if fetch_output() missed'''
+        if self.output_cache_key is not None:
+            key, info = self.output_cache_key
+            cache = OutputCache(self.output_cache, self.output_cache_mb << 20)
+            cache.store(key, self.output_files(), info)
+
+    def loop(self):
+        """Open window and run infinite event loop"""
+        pygame.key.set_repeat(100, 100)
 
         # Init window attribute
         pygame.display.set_caption("PyTiler")
@@ -219,95 +1933,920 @@ class PyTiler:
         # Set screen size
         size = self.width, self.height
         self.display = pygame.display.set_mode(size)
+        if self.demo:
+            return self.demo_loop()
         self.draw()
 
         while True:
-            # Process events
-            if pygame.event.peek():
-                for event in pygame.event.get():
+            # Sleep until next event
+            event = pygame.event.wait()
+            for event in [event] + pygame.event.get():
+                if event.type == pygame.QUIT:
+                    return
+                elif event.type == pygame.KEYDOWN:
+                    if event.unicode in ('q', 'Q') or \
+                       event.key == pygame.K_ESCAPE:
+                        return
+                    elif event.key == pygame.K_SPACE:
+                        self.draw()
+                    elif event.unicode == 'b':
+                        self.brick = not self.brick
+                        self.draw()
+                    elif event.unicode == 'r':
+                        self.set_rotate(not self.rotate)
+                    elif event.unicode == 's':
+                        self.save()
+
+    def demo_loop(self):
+        '''Show a new frame every frame_delay seconds, while next frame is
+        rendered in background. Options changed by keys apply to next frame.'''
+        # Frames are redrawn continuously, transform all tiles up front
+        self.warm_tiles()
+        producer = FrameProducer(self, self.display)
+
+        frame_delay = 1/5.0
+        start = next_frame = time.monotonic()
+        frames = dropped = 0
+        # Show first frame as soon as it is ready
+        late = True
+        try:
+            while True:
+                if late:
+                    event = pygame.event.wait()
+                else:
+                    timeout = int((next_frame - time.monotonic()) * 1000)
+                    event = pygame.event.wait(max(timeout, 1))
+                show = False
+                for event in [event] + pygame.event.get():
                     if event.type == pygame.QUIT:
                         return
+                    elif event.type == FrameProducer.FRAME_READY:
+                        if producer.error is not None:
+                            raise producer.error
+                        show = late
                     elif event.type == pygame.KEYDOWN:
                         if event.unicode in ('q', 'Q') or \
                            event.key == pygame.K_ESCAPE:
                             return
                         elif event.key == pygame.K_SPACE:
-                            self.draw()
+                            show = True
                         elif event.unicode == 'b':
-                            self.brick = not self.brick
-                            self.draw()
+                            producer.toggle('brick')
                         elif event.unicode == 'r':
-                            self.rotate = not self.rotate
-                            self.draw()
+                            producer.toggle('rotate')
                         elif event.unicode == 's':
                             self.save()
-            if self.demo:
-                time.sleep(1/5.0)
-                self.draw()
+
+                now = time.monotonic()
+                due = not late and now >= next_frame
+                if not (show or due):
+                    continue
+                if producer.ready is None:
+                    # Next frame is not rendered yet, show it when it is
+                    if due:
+                        dropped += 1
+                    late = True
+                    continue
+
+                with stats.phase('flip'):
+                    self.layout = producer.present(self.display)
+                    pygame.display.flip()
+                frames += 1
+                late = False
+                next_frame += frame_delay
+                if next_frame < now:
+                    next_frame = now + frame_delay
+                pygame.display.set_caption("PyTiler - %.1f fps, %d dropped" %
+                                           (frames / max(now - start, 1e-6), dropped))
+        finally:
+            producer.stop()
+            elapsed = time.monotonic() - start
+            print("Demo: %d frames in %.1fs, %.1f fps, %d dropped" %
+                  (frames, elapsed, frames / max(elapsed, 1e-6), dropped))
+
+    def warm_tiles(self):
+        '''Fill tiles variant cache with every size and angle draw() may use'''
+        angles = [0, 90, 180, 270] if self.rotate else [0]
+        for tile in self.tiles:
+            if self.random_width:
+                width = tile.rect.width
             else:
-                time.sleep(1/60.0)
+                width = self.tile_width
+            tile.warm(width, self.tile_height, angles)
 
     def draw(self):
         '''Draw tiles'''
         self.display.fill(pygame.Color('#00000000'))
-        y = 0
-        while y < self.height:
-            # Set first tile offset
-            if self.brick:
-                x = -random.randrange(0, self.tile_width)
-                print("X offset = %d" % x)
-            else:
-                x = 0
-            first_tile = None
-            first_tile_angle = 0
-
-            while x < self.width:
-                # Choose next tile
-                if len(self.tiles) == 0:
-                    if len(self.tiles_trash) > 0:
-                        # Swap tile list
-                        self.tiles = self.tiles_trash
-                        self.tiles_trash = []
-                    else:
-                        raise Exception("Error: tile list is empty")
-                tile = random.choice(self.tiles)
-                if self.remove_after_use:
-                    self.tiles_trash.append(tile)
-                    self.tiles.remove(tile)
-
-                # Set rotation
-                if self.rotate:
-                    angle = random.choice([0, 90, 180, 270])
-                    #angle = random.randrange(0, 360)
-                else:
+        self.layout = self.plan()
+        self.rasterize(self.layout, self.display)
+
+        if self.display is pygame.display.get_surface():
+            with stats.phase('flip'):
+                pygame.display.flip()
+
+    def set_rotate(self, rotate):
+        '''Turn tiles rotation on or off in current layout, and draw again
+        only the tiles whose angle changed'''
+        self.rotate = rotate
+        layout = self.layout
+        changed = []
+        for row in range(layout.nr_rows):
+            start, end = layout.bounds(row, row + 1)
+            for i in range(start, end):
+                if not rotate:
                     angle = 0
+                elif i > start and self.brick and layout.tile[i] == layout.tile[start] and \
+                     layout.x[i] + self.tiles[layout.tile[start]].rect.width > layout.width:
+                    # Tile wrapping at end of line keeps first tile angle
+                    angle = layout.angle[start]
+                else:
+                    angle = random.choice([0, 90, 180, 270])
+                if angle != layout.angle[i]:
+                    layout.angle[i] = angle
+                    changed.append(i)
+        self.redraw(changed)
+
+    def redraw(self, indices):
+        '''Draw again the given placements of current layout, and update
+        only their rows on screen'''
+        layout = self.layout
+        height = layout.tile_height
+        background = pygame.Color('#00000000')
+        screen = self.display.get_rect()
+        dirty = {}
+        for i in indices:
+            row, x, width = int(layout.row[i]), int(layout.x[i]), int(layout.w[i])
+            # Clip first, fill() does not handle negative x of brick rows
+            rect = pygame.Rect(x, row * height, width, height).clip(screen)
+            # Tiles may have per pixel alpha, clear previous tile first
+            self.display.fill(background, rect)
+            self.tiles[layout.tile[i]].draw_at(self.display, x, row * height, width, height, int(layout.angle[i]))
+            dirty[row] = dirty[row].union(rect) if row in dirty else rect
+
+        if self.display is pygame.display.get_surface():
+            with stats.phase('flip'):
+                pygame.display.update(list(dirty.values()))
+
+    def row_random(self, row):
+        '''Return a random generator for row of current frame, derived from
+        seed only. The first frame of a seed is the same in every mode.'''
+        if self.frame == 0:
+            return random.Random("%d:%d" % (self.seed, row))
+        return random.Random("%d:%d:%d" % (self.seed, self.frame, row))
+
+    def new_layout(self):
+        '''Return an empty layout for current options and tiles'''
+        tiles = None
+        if not self.auto:
+            tiles = [tile.filename for tile in self.tiles]
+        return Layout(self.width, self.height, self.tile_width, self.tile_height, tiles)
+
+    def plan(self):
+        '''Choose tiles, angles and positions of the whole texture and
+        return them as a Layout. A layout loaded from file is returned as is.
+        With pygame engine, every row is planned with its own random generator
+        and sampler, so it does not depend on previous ones: serial, --jobs,
+        --stream and --batch renders of a seed are the same.'''
+        if self.layout_in is not None:
+            return self.layout_in
+        if len(self.tiles) == 0:
+            raise Exception("Error: tile list is empty")
+        with stats.phase('layout'):
+            if self.engine == 'numpy':
+                return self.plan_numpy()
+            layout = self.new_layout()
+            for row in range(layout.nr_rows):
+                self.plan_row(layout, row, self.row_random(row), self.make_sampler())
+            self.frame += 1
+            return layout
+
+    def plan_row(self, layout, row, rng, sampler):
+        '''Append placements of one row of tiles to layout'''
+        # Set first tile offset
+        if self.brick:
+            x = -rng.randrange(0, self.tile_width)
+            debug("X offset = %d" % x)
+        else:
+            x = 0
+        first_tile = None
+        first_tile_angle = 0
+
+        while x < self.width:
+            # Choose next tile
+            index = sampler.sample(rng)
+            tile = self.tiles[index]
+
+            # Set rotation
+            if self.rotate:
+                angle = rng.choice([0, 90, 180, 270])
+                #angle = rng.randrange(0, 360)
+            else:
+                angle = 0
+
+            # Save first tile of current line
+            # It is used to complete end of line, so wrapping is correct
+            if first_tile is None:
+                first_tile = index
+                first_tile_angle = angle
+
+            if self.brick and (x + self.tiles[first_tile].rect.width) > self.width:
+                index = first_tile
+                tile = self.tiles[first_tile]
+                angle = first_tile_angle
 
-                # Save first tile of current line
-                # It is used to complete end of line, so wrapping is correct
-                if first_tile is None:
-                    first_tile = tile
-                    first_tile_angle = angle
+            if self.random_width:
+                width = tile.rect.width
+            else:
+                width = self.tile_width
+            layout.append(row, x, width, index, angle)
+
+            x += width
 
-                if self.brick and (x + first_tile.rect.width) > self.width:
-                    tile = first_tile
-                    angle = first_tile_angle
+    def plan_numpy(self):
+        '''Vectorized plan(), with the NumPy random generator'''
+        nr_rows = -(-self.height // self.tile_height)
+        nr_tiles = len(self.tiles)
+        rect_widths = numpy.array(tile_widths(self.tiles))
+        if self.random_width:
+            widths = rect_widths
+        else:
+            widths = numpy.full(nr_tiles, self.tile_width)
+        if self.brick:
+            offsets = -self.rng.integers(0, self.tile_width, nr_rows)
+        else:
+            offsets = numpy.zeros(nr_rows, numpy.intp)
 
-                # Draw tile
-                if self.random_width:
-                    width = tile.rect.width
+        if not self.random_width:
+            # Every tile has the same width, so the number of tiles per row
+            # is known and all of them can be drawn at once
+            counts = (self.width - offsets + self.tile_width - 1) // self.tile_width
+            total = counts.sum()
+            tiles = self.tile_sampler.sample_array(total, self.rng)
+            angles = self.rng.integers(0, 4 if self.rotate else 1, total) * 90
+            rows = numpy.repeat(numpy.arange(nr_rows), counts)
+            firsts = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+            xs = offsets[rows] + (numpy.arange(total) - firsts) * self.tile_width
+            if self.brick:
+                # Complete end of line with first tile, so wrapping is correct
+                wrap = xs + rect_widths[tiles[firsts]] > self.width
+                tiles[wrap] = tiles[firsts][wrap]
+                angles[wrap] = angles[firsts][wrap]
+        else:
+            # Random widths: draw tiles by chunks which are known to fit in the row
+            max_width = widths.max()
+            all_rows, all_xs, all_tiles, all_angles = [], [], [], []
+            for row in range(nr_rows):
+                x = offsets[row]
+                first = None
+                while x < self.width:
+                    count = max(1, (self.width - x) // max_width)
+                    tiles = self.tile_sampler.sample_array(count, self.rng)
+                    angles = self.rng.integers(0, 4 if self.rotate else 1, count) * 90
+                    if first is None:
+                        first = tiles[0], angles[0]
+                    xs = x + numpy.cumsum(widths[tiles]) - widths[tiles]
+                    if self.brick:
+                        wrap = numpy.flatnonzero(xs + rect_widths[first[0]] > self.width)
+                        if len(wrap) > 0:
+                            end = wrap[0] + 1
+                            tiles, angles, xs = tiles[:end], angles[:end], xs[:end]
+                            tiles[-1], angles[-1] = first
+                    all_rows.append(numpy.full(len(tiles), row))
+                    all_xs.append(xs)
+                    all_tiles.append(tiles)
+                    all_angles.append(angles)
+                    x = xs[-1] + widths[tiles[-1]]
+            rows, xs = numpy.concatenate(all_rows), numpy.concatenate(all_xs)
+            tiles, angles = numpy.concatenate(all_tiles), numpy.concatenate(all_angles)
+
+        layout = self.new_layout()
+        layout.set_columns(rows, xs, widths[tiles], tiles, angles)
+        return layout
+
+    def rasterize(self, layout, surface, first_row=0, last_row=None):
+        '''Draw rows first_row to last_row (excluded) of layout on surface,
+        with first_row at the top of surface'''
+        if last_row is None:
+            last_row = layout.nr_rows
+        layout = layout.slice(first_row, last_row)
+        stats.count('tiles_placed', len(layout))
+        with stats.phase('compose'):
+            if self.engine == 'numpy':
+                self.build_atlas(layout)
+                if surface.get_bitsize() == 32 and surface.get_masks() == self.atlas_masks:
+                    self.compose_numpy(layout, surface, first_row, last_row)
                 else:
-                    width = self.tile_width
-                tile.draw_at(self.display, x, y, width, self.tile_height, angle)
+                    # Atlas pixels are only valid in their own format
+                    band = pygame.Surface(surface.get_size(), 0, 32)
+                    self.compose_numpy(layout, band, first_row, last_row)
+                    surface.blit(band, (0, 0))
+                return
+            for row, x, width, index, angle in zip(*layout.columns()):
+                y = (row - first_row) * layout.tile_height
+                self.tiles[index].draw_at(surface, x, y, width, layout.tile_height, angle)
+
+    # Atlas keys are tile index * atlas_stride + width
+    atlas_stride = 1 << 20
+
+    def build_atlas(self, layout):
+        '''Stack every tile, at every width and angle layout draws it with,
+        into a single array of mapped 32 bit pixels indexed by
+        [variant, angle, x, y]. Tiles narrower than the widest one are padded
+        with black.'''
+        tiles, widths, angles = [numpy.asarray(c, numpy.int64) for c in (layout.tile, layout.w, layout.angle)]
+        # Always include tiles at their usual width, so the atlas does not
+        # change between frames
+        if self.random_width:
+            nominal = tile_widths(self.tiles)
+        else:
+            nominal = [layout.tile_width] * len(self.tiles)
+        keys = numpy.sort(numpy.concatenate((numpy.arange(len(self.tiles)) * self.atlas_stride + nominal,
+                                             tiles * self.atlas_stride + widths)))
+        # Same as numpy.union1d(), which imports numpy.ma on first use and
+        # takes longer than composing a whole frame
+        keys = keys[numpy.concatenate(([True], keys[1:] != keys[:-1]))]
+        all_angles = [0, 90, 180, 270] if self.rotate or angles.any() else [0]
+        # Tiles are keyed by their sequence, so that tiles of a TileAtlas
+        # are not made just to be compared. The atlas keeps a reference to
+        # it, so that its id is not reused.
+        key = (id(self.tiles), len(self.tiles), keys.tobytes(), len(all_angles), layout.tile_height)
+        if key == self.atlas_key:
+            return
+
+        variants = [divmod(int(k), self.atlas_stride) for k in keys]
+        max_width = max(width for _, width in variants)
+        atlas = numpy.zeros((len(variants), len(all_angles), max_width, layout.tile_height), numpy.uint32)
+        # Tiles are blitted on black like on the display, so per pixel alpha
+        # gives exactly the same colors as pygame engine
+        back = pygame.Surface((max_width, layout.tile_height), 0, 32)
+        for i, (index, width) in enumerate(variants):
+            for j, angle in enumerate(all_angles):
+                back.fill(pygame.Color('#00000000'))
+                back.blit(self.tiles[index].variant(width, layout.tile_height, angle), (0, 0))
+                atlas[i, j, :width] = pygame.surfarray.array2d(back)[:width]
+
+        self.atlas = atlas
+        self.atlas_masks = back.get_masks()
+        self.atlas_key = key
+        self.atlas_tiles = self.tiles
+        self.atlas_keys = keys
+
+    def compose_numpy(self, layout, surface, first_row, last_row):
+        '''Copy tiles of layout rows first_row to last_row (excluded) from
+        atlas into surface pixels, with first_row at the top of surface.
+        Surface must have the pixel format of atlas.'''
+        rows, xs, widths, tiles, angles = layout.arrays()
+        variants = numpy.searchsorted(self.atlas_keys, tiles * self.atlas_stride + widths)
+        if self.atlas.shape[1] > 1:
+            angles = angles // 90
+        else:
+            angles = numpy.zeros_like(angles)
+        atlas_width, tile_height = self.atlas.shape[2:]
+        nr_rows = last_row - first_row
+        width = min(layout.width, surface.get_width())
+        height = min(nr_rows * tile_height, layout.height - first_row * tile_height, surface.get_height())
+        # Atlas as a table of pixel columns, and first column of each tile
+        columns = self.atlas.reshape(-1, tile_height)
+        first_columns = (variants * self.atlas.shape[1] + angles) * atlas_width
+        pixels = pygame.surfarray.pixels2d(surface)
+        starts = numpy.searchsorted(rows, numpy.arange(first_row, last_row + 1))
+        for row in range(nr_rows):
+            y = row * tile_height
+            bottom = min(y + tile_height, height)
+            start, end = starts[row], starts[row + 1]
+            if start == end or y >= bottom:
+                continue
+            # Gather all tiles of the row with one index, then reshape them
+            # into the pixel columns of the whole row
+            x = int(xs[start])
+            if (widths[start:end] == atlas_width).all():
+                band = self.atlas[variants[start:end], angles[start:end], :, :bottom - y]
+                band = band.reshape(-1, bottom - y)
+            else:
+                # Narrower tiles are padded in atlas: gather pixel columns
+                cells = numpy.repeat(numpy.arange(start, end), widths[start:end])
+                band = columns[numpy.arange(len(cells)) + x - xs[cells] + first_columns[cells], :bottom - y]
+            left, right = max(x, 0), min(x + len(band), width)
+            if left < right:
+                pixels[left:right, y:bottom] = band[left - x:right - x]
+        del pixels
+
+    def render_strips(self, writer):
+        '''Render tiles one row at a time into writer, then close it.
+        Only one row of tiles is held in memory, and output is the same as
+        saving a full render with the same seed.'''
+        if len(self.tiles) == 0:
+            self.init_seed()
+            self.load_tiles()
+        if self.jobs > 0:
+            # Bands of a fixed height, so that memory does not grow with
+            # output height
+            for y, data in self.render_bands(max(1, 64 // self.tile_height)):
+                with stats.phase('save'):
+                    writer.write(data)
+            with stats.phase('save'):
+                writer.close()
+            return
 
-                x += width
-            y += self.tile_height
+        self.layout = self.plan()
+        band = pygame.Surface((self.width, self.tile_height), 0, 32)
+        for row in range(self.layout.nr_rows):
+            band.fill(pygame.Color('#00000000'))
+            self.rasterize(self.layout, band, row, row + 1)
+            height = min(self.tile_height, self.height - row * self.tile_height)
+            rect = pygame.Rect(0, 0, self.width, height)
+            with stats.phase('save'):
+                writer.write(pygame.image.tostring(band.subsurface(rect), 'RGB'))
+        with stats.phase('save'):
+            writer.close()
 
-        pygame.display.flip()
+    def draw_band(self, layout, first_row, last_row):
+        '''Draw rows first_row to last_row (excluded) of layout.
+        Returns band pixels as RGB bytes.'''
+        band = pygame.Surface((layout.width, (last_row - first_row) * layout.tile_height), 0, 32)
+        band.fill(pygame.Color('#00000000'))
+        self.rasterize(layout, band, first_row, last_row)
+        height = min(band.get_height(), layout.height - first_row * layout.tile_height)
+        return pygame.image.tostring(band.subsurface(pygame.Rect(0, 0, layout.width, height)), 'RGB')
+
+    def render_bands(self, band_rows=None):
+        '''Plan whole texture, then rasterize bands of band_rows rows (default:
+        a fraction of the texture per process) in a pool of self.jobs
+        processes. Yields (y, RGB bytes) of each band, in order. At most two
+        bands per process are drawn or waiting to be consumed.'''
+        if len(self.tiles) == 0:
+            self.init_seed()
+            self.load_tiles()
+        self.layout = self.plan()
+        nr_rows = self.layout.nr_rows
+        if band_rows is None:
+            band_rows = max(1, nr_rows // (self.jobs * 4))
+        tasks = ((self.layout.slice(first_row, min(first_row + band_rows, nr_rows)),
+                  first_row, min(first_row + band_rows, nr_rows))
+                 for first_row in range(0, nr_rows, band_rows))
+
+        if self.jobs == 1:
+            for task in tasks:
+                yield task[1] * self.tile_height, self.draw_band(*task)
+            return
+
+        # Workers are spawned rather than forked, so they do not inherit SDL
+        # state and signal handlers from an initialized pygame
+        context = multiprocessing.get_context('spawn')
+        pool = context.Pool(self.jobs, init_worker, (self.get_options(),))
+        try:
+            pending = collections.deque()
+            for task in itertools.chain(tasks, [None]):
+                if task is not None:
+                    pending.append((task[1], pool.apply_async(draw_band, (task,))))
+                while pending and (task is None or len(pending) >= 2 * self.jobs):
+                    first_row, result = pending.popleft()
+                    data, report = result.get()
+                    # Workers time their own phases
+                    stats.merge(report)
+                    yield first_row * self.tile_height, data
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def load_layout(self):
+        '''Load layout file, matching its tiles with current ones, and scale
+        it to current tile size'''
+        layout = Layout.load(self.layout_file)
+        if layout.tiles is not None:
+            # Tiles files may have been listed in another order
+            indices = dict((tile.filename, i) for i, tile in enumerate(self.tiles))
+            missing = [name for name in layout.tiles if name not in indices]
+            if missing:
+                error("Tile '%s' of layout not found" % missing[0])
+                sys.exit(1)
+            layout.tile = array.array('i', [indices[layout.tiles[i]] for i in layout.tile])
+            layout.tiles = [tile.filename for tile in self.tiles]
+        elif max(layout.tile, default=-1) >= len(self.tiles):
+            error("Layout uses %d tiles, only %d available" % (max(layout.tile) + 1, len(self.tiles)))
+            sys.exit(1)
+        if (layout.tile_width, layout.tile_height) != (self.tile_width, self.tile_height):
+            layout = layout.scaled(self.tile_width, self.tile_height)
+        self.width = layout.width
+        self.height = layout.height
+        self.layout_in = layout
+
+    def tilemap_output(self):
+        return os.path.splitext(self.outfilename)[1].lower() == '.tilemap'
+
+    def region_rect(self):
+        '''Return --region as a pygame.Rect, or None'''
+        if not self.region:
+            return None
+        values = [int(value) for value in self.region.split(',')]
+        if len(values) != 4 or values[2] <= 0 or values[3] <= 0:
+            raise ValueError(self.region)
+        return pygame.Rect(values)
+
+    def render_tilemap(self):
+        '''Render --from-tilemap file, or its region, into output file'''
+        try:
+            tilemap = TileMap.load(self.from_tilemap)
+            self.display = tilemap.render(self.region_rect())
+        except (OSError, ValueError) as e:
+            error(e)
+            sys.exit(1)
+        if not self.region:
+            # Output may be a tile map again
+            self.tiles = tilemap.atlas
+            self.layout = tilemap.layout
+        self.width, self.height = self.display.get_size()
+        self.save()
 
     def save(self):
-        '''Save tiles to output file'''
-        pygame.image.save(self.display, self.outfilename)
-        print("Saved tiles into " + self.outfilename)
+        '''Save tiles to output file, with mipmaps if requested'''
+        if self.tilemap_output():
+            if self.mipmaps:
+                error("Tile maps have no mipmaps")
+                sys.exit(1)
+            if self.layout is None:
+                error("No layout to save as tile map")
+                sys.exit(1)
+            with stats.phase('save'):
+                TileMap(self.layout, TileAtlas.of_tiles(self.tiles)).save(self.outfilename)
+            print("Saved tile map into " + self.outfilename)
+            self.save_layout()
+            return
+        levels = self.mipmap_levels()
+        if os.path.splitext(self.outfilename)[1].lower() == '.ktx':
+            with stats.phase('save'):
+                self.save_ktx(levels)
+            print("Saved tiles into " + self.outfilename)
+        else:
+            display = self.display
+            if self.saver is not None and (levels or display is pygame.display.get_surface()):
+                # Saved in the background, while mipmaps are shrunk from
+                # display pixels or the window is drawn again
+                display = display.copy()
+            self.save_file(display, self.outfilename, "Saved tiles into " + self.outfilename)
+            for level, surface in self.mipmaps_of(self.display, levels):
+                root, ext = os.path.splitext(self.outfilename)
+                filename = "%s.mip%d%s" % (root, level, ext)
+                self.save_file(surface, filename, "Saved mipmap level %d into %s" % (level, filename))
+        self.save_layout()
+
+    def save_file(self, surface, filename, message):
+        '''Save surface into filename, in the background if there is a saver,
+        then print message'''
+        def save():
+            with stats.phase('save'):
+                save_surface(surface, filename, self.png_level, self.encode_threads)
+
+        if self.saver is None:
+            save()
+            print(message)
+        else:
+            self.saver.submit(save, message)
+
+    def save_ktx(self, levels):
+        '''Save output and every mipmap level up to the last requested one
+        into a KTX file, as KTX needs a complete mipmap chain'''
+        levels = list(range(1, max(levels, default=0) + 1))
+        width, height = self.display.get_size()
+        writer = KtxWriter(self.outfilename, width, height, len(levels) + 1)
+        writer.write_level(pygame.image.tostring(self.display, 'RGB'), width, height)
+        for level, surface in self.mipmaps_of(self.display, levels):
+            writer.write_level(pygame.image.tostring(surface, 'RGB'), *surface.get_size())
+        writer.close()
+
+    def mipmap_levels(self):
+        '''Return sorted mipmap levels of --mipmaps, without level 0 which
+        is output itself. Levels smaller than 1 pixel are ignored.'''
+        if not self.mipmaps:
+            return []
+        last = max(self.width, self.height).bit_length() - 1
+        if self.mipmaps == 'all':
+            return list(range(1, last + 1))
+        levels = set()
+        for part in self.mipmaps.split(','):
+            first, _, end = part.partition('-')
+            levels.update(range(int(first), int(end or first) + 1))
+        return sorted(level for level in levels if 1 <= level <= last)
+
+    def mipmaps_of(self, surface, levels):
+        '''Yield (level, surface) of each requested level. Each level is
+        shrunk from the previous one, with a box filter.'''
+        if not levels:
+            return
+        width, height = surface.get_size()
+        if numpy is None:
+            # Without NumPy, smoothscale() also averages pixels when halving
+            for level in range(1, levels[-1] + 1):
+                surface = pygame.transform.smoothscale(surface, (max(1, width >> level),
+                                                                 max(1, height >> level)))
+                if level in levels:
+                    yield level, surface
+            return
+        pixels = pygame.surfarray.pixels3d(surface)
+        for level in range(1, levels[-1] + 1):
+            with stats.phase('mipmap'):
+                pixels = shrink_pixels(pixels, max(1, width >> level), max(1, height >> level))
+            if level in levels:
+                yield level, pygame.surfarray.make_surface(pixels)
+
+    def save_layout(self):
+        '''Save layout of last drawn tiles, if requested'''
+        if self.layout_out and self.layout is not None:
+            self.layout.save(self.layout_out)
+            print("Saved layout into " + self.layout_out)
+
+
+#-------------------------------------------------------------------------------
+class RenderServer:
+    '''Runs render jobs one at a time, keeping decoded sources and tiles,
+    with their transformed variants, in memory between jobs.
+
+    A job is a JSON line: {"id": any, "args": command line arguments as a
+    list or a string, "options": {PyTiler option: value} applied after
+    args, "return": true to get PNG output in the answer}.
+    It is answered with a JSON line: {"id", "ok", "output", "seconds",
+    "phases", "counters"} and "png" (base64) if returned, or {"id", "ok":
+    false, "error"} if it failed.'''
+
+    def __init__(self, cache_mb, bands=True):
+        self.memory_cache = MemoryCache(cache_mb << 20)
+        # Whether jobs may render bands in processes (--jobs)
+        self.bands = bands
+
+    def run_job(self, job):
+        '''Render job, return its answer'''
+        global verbose
+        start = time.perf_counter()
+        stats.reset()
+        answer = {'id': job.get('id')}
+        tiler = PyTiler()
+        tiler.memory_cache = self.memory_cache
+        tmp_path = None
+        try:
+            args = job.get('args', [])
+            if isinstance(args, str):
+                args = shlex.split(args)
+            tiler.parse_args(args)
+            options = job.get('options', {})
+            tiler.set_options(dict((name, tiler.convert_option(name, value))
+                                   for name, value in options.items()))
+            if not self.bands:
+                tiler.jobs = 0
+            verbose = tiler.verbose
+            if job.get('return'):
+                fd, tmp_path = tempfile.mkstemp(suffix='.png')
+                os.close(fd)
+                tiler.outfilename = tmp_path
+            if not tiler.fetch_output():
+                tiler.init_seed()
+                tiler.load_tiles()
+                tiler.render_output()
+            if tmp_path is not None:
+                with open(tmp_path, 'rb') as f:
+                    answer['png'] = base64.b64encode(f.read()).decode()
+            else:
+                answer['output'] = tiler.outfilename
+            answer['ok'] = True
+        except SystemExit:
+            # Invalid arguments or files, reported with error()
+            answer.update(ok=False, error=None)
+        except Exception as e:
+            answer.update(ok=False, error="%s: %s" % (type(e).__name__, e))
+        finally:
+            if tiler.loader is not None:
+                tiler.loader.close()
+            if tmp_path is not None:
+                os.remove(tmp_path)
+            self.memory_cache.trim()
+        answer['seconds'] = time.perf_counter() - start
+        answer.update(stats.report())
+        return answer
+
+    def run_line(self, line):
+        '''Run job of a JSON line, return answer as a JSON line'''
+        try:
+            job = json.loads(line)
+        except ValueError as e:
+            return json.dumps({'ok': False, 'error': "Invalid JSON: %s" % e}) + '\n'
+        # Progress messages would mix with answers on standard output
+        log = io.StringIO()
+        with contextlib.redirect_stdout(log):
+            answer = self.run_job(job)
+        sys.stderr.write(log.getvalue())
+        if answer['ok'] is False and answer['error'] is None:
+            errors = [line[len("Error: "):] for line in log.getvalue().splitlines()
+                      if line.startswith("Error: ")]
+            answer['error'] = errors[-1] if errors else "Invalid job"
+        return json.dumps(answer) + '\n'
+
+    def serve(self, input, output=None):
+        '''Run jobs read from input file until its end. Answers are written
+        to output, by default to standard output, which only answers are
+        written to (see protocol_output()).'''
+        if output is None:
+            output = protocol_output()
+        for line in input:
+            if line.strip():
+                output.write(self.run_line(line))
+                output.flush()
+
+    def serve_socket(self, path):
+        '''Run jobs sent to a Unix socket, one connection at a time'''
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if line.strip():
+                        self.wfile.write(server.run_line(line.decode()).encode())
+
+        if os.path.exists(path):
+            os.remove(path)
+        with socketserver.UnixStreamServer(path, Handler) as unix_server:
+            print("Serving on " + path)
+            try:
+                unix_server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.remove(path)
+
+
+def protocol_output():
+    '''Return a file writing to a duplicate of standard output, then send
+    standard output to standard error, so that messages of PyTiler, pygame
+    and child processes can not mix with what is written to the file'''
+    sys.stdout.flush()
+    output = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    return output
+
+
+#-------------------------------------------------------------------------------
+class BatchRunner:
+    '''Runs the jobs of a manifest in a pool of processes, each one running
+    jobs like a RenderServer.
+
+    A JSON manifest is a list of jobs or JSON lines, jobs being those of
+    RenderServer. A CSV manifest has a header line, optional "id" and
+    "args" columns, and other columns named after PyTiler options.
+    Jobs without id are numbered in manifest order.
+
+    Jobs are sorted by input, so that each worker mostly gets jobs of the
+    same source, which it decodes once. Answers are appended to a results
+    file as jobs end; jobs which succeeded are not run again by a next run.'''
+
+    def __init__(self, manifest, workers, cache_mb):
+        self.manifest = manifest
+        self.workers = workers
+        self.cache_mb = cache_mb
+        self.results = manifest + '.results.jsonl'
+
+    def read_manifest(self):
+        with open(self.manifest, newline='') as f:
+            if self.manifest.lower().endswith('.csv'):
+                jobs = []
+                for row in csv.DictReader(f):
+                    job = {}
+                    for key in ('id', 'args'):
+                        if row.get(key):
+                            job[key] = row.pop(key)
+                    options = dict((name, value) for name, value in row.items() if value)
+                    if options:
+                        job['options'] = options
+                    jobs.append(job)
+            else:
+                text = f.read().strip()
+                if text.startswith('['):
+                    jobs = json.loads(text)
+                else:
+                    jobs = [json.loads(line) for line in text.splitlines() if line.strip()]
+        for i, job in enumerate(jobs):
+            job.setdefault('id', i)
+        return jobs
+
+    def done_ids(self):
+        '''Return ids of jobs which succeeded in previous runs'''
+        done = set()
+        if os.path.isfile(self.results):
+            with open(self.results) as f:
+                for line in f:
+                    try:
+                        answer = json.loads(line)
+                    except ValueError:
+                        # Last line of an interrupted run
+                        continue
+                    if answer.get('ok'):
+                        done.add(json.dumps(answer.get('id')))
+        return done
+
+    @staticmethod
+    def input_of(job):
+        '''Return the source file or tiles prefix of job, to group jobs'''
+        tiler = PyTiler()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                args = job.get('args', [])
+                tiler.parse_args(shlex.split(args) if isinstance(args, str) else args)
+                options = job.get('options', {})
+                tiler.set_options(dict((name, tiler.convert_option(name, value))
+                                       for name, value in options.items()))
+        except (SystemExit, Exception):
+            # Reported when job is run
+            return ""
+        if tiler.auto:
+            return os.path.abspath(tiler.filename)
+        return os.path.abspath(tiler.prefix)
+
+    def run(self):
+        jobs = self.read_manifest()
+        done = self.done_ids()
+        todo = [job for job in jobs if json.dumps(job['id']) not in done]
+        if len(todo) < len(jobs):
+            print("Skipping %d jobs done by a previous run" % (len(jobs) - len(todo)))
+        todo.sort(key=self.input_of)
+        lines = [json.dumps(job) + '\n' for job in todo]
+
+        start = time.perf_counter()
+        failed = []
+        with open(self.results, 'a') as results:
+            if self.workers == 1 or len(lines) <= 1:
+                init_batch_worker(self.cache_mb)
+                answers = map(run_batch_job, lines)
+                pool = None
+            else:
+                context = multiprocessing.get_context('spawn')
+                pool = context.Pool(self.workers, init_batch_worker, (self.cache_mb,))
+                # Consecutive jobs, of the same source, go to the same worker
+                chunk_size = max(1, min(8, len(lines) // (self.workers * 4)))
+                answers = pool.imap_unordered(run_batch_job, lines, chunk_size)
+            try:
+                for line in answers:
+                    results.write(line)
+                    results.flush()
+                    answer = json.loads(line)
+                    if not answer.get('ok'):
+                        failed.append(answer)
+                if pool is not None:
+                    pool.close()
+            except:
+                if pool is not None:
+                    pool.terminate()
+                raise
+            finally:
+                if pool is not None:
+                    pool.join()
+        elapsed = time.perf_counter() - start
+
+        for answer in failed:
+            error("Job %s: %s" % (json.dumps(answer.get('id')), answer.get('error')))
+        print("Batch: %d jobs, %d done, %d failed, %d skipped in %.1fs (%.2f jobs/s)" %
+              (len(jobs), len(todo) - len(failed), len(failed), len(jobs) - len(todo),
+               elapsed, len(todo) / max(elapsed, 1e-6)))
+        print("Results in " + self.results)
+        if failed:
+            print("Run the batch again to retry failed jobs")
+
+
+#-------------------------------------------------------------------------------
+# Process pool workers for BatchRunner
+
+batch_server = None
+
+def init_batch_worker(cache_mb):
+    '''Create the render server once per worker process'''
+    global batch_server
+    pygame.init()
+    # Pool processes can not start processes of their own: --jobs of
+    # a manifest is the number of batch workers, jobs render in one process
+    batch_server = RenderServer(cache_mb, bands=False)
+
+def run_batch_job(line):
+    return batch_server.run_line(line)
+
+
+#-------------------------------------------------------------------------------
+# Process pool workers for PyTiler.render_bands()
+
+worker_tiler = None
+
+def init_worker(options):
+    '''Create the tiles once per worker process'''
+    global worker_tiler, verbose
+    worker_tiler = PyTiler()
+    worker_tiler.set_options(options)
+    verbose = worker_tiler.verbose
+    worker_tiler.init_seed()
+    worker_tiler.load_tiles()
+
+def draw_band(task):
+    '''Return band pixels, and stats of drawing them'''
+    stats.reset()
+    data = worker_tiler.draw_band(*task)
+    return data, stats.report()
 
 
 #-------------------------------------------------------------------------------